@@ -0,0 +1,236 @@
+"""
+asyncio client for the Single Quantum WebSQ driver.
+
+Same commands as WebSQControl, but both ports are read by tasks of one event
+loop instead of one thread per socket. Several drivers (and other
+instruments) can therefore be driven concurrently from a single loop:
+
+    async with AsyncWebSQControl("192.168.1.163") as a, AsyncWebSQControl("192.168.1.164") as b:
+        await asyncio.gather(a.set_bias_current(Ia), b.set_bias_current(Ib))
+        cnts_a, cnts_b = await asyncio.gather(a.aquire_cnts(10), b.aquire_cnts(10))
+"""
+
+import asyncio
+import json
+import time
+
+from WebSQControl import CountsFramer, CountsRingBuffer, JSONStreamDecoder, SQTimeoutError
+
+class AsyncWebSQControl(object):
+    def __init__(self, TCP_IP_ADR = 'localhost', CONTROL_PORT = 12000, COUNTS_PORT = 12345, CNTS_BUFFER = 100, CNTS_BUFFER_BYTES = None):
+        self.TCP_IP_ADR  = TCP_IP_ADR
+        self.CONTROL_PORT = CONTROL_PORT
+        self.COUNTS_PORT = COUNTS_PORT
+        self.CNTS_BUFFER = CNTS_BUFFER
+        self.CNTS_BUFFER_BYTES = CNTS_BUFFER_BYTES
+        self.BUFFER = 1000000
+        self.NUMBER_OF_DETECTORS = 0
+        #Timeout (s) for label requests, same as SQTalk.get_label
+        self.LABEL_TIMEOUT = 10
+        #Raise if no frame arrives for this long (s) while waiting, same as SQCounts
+        self.STALL_TIMEOUT = 10
+
+        self.labelProps = dict()
+        self.shutdown = False
+        self._tasks = []
+
+    async def connect(self):
+        (self._ctrl_reader, self._ctrl_writer), (self._cnts_reader, self._cnts_writer) = await asyncio.gather(
+            asyncio.open_connection(self.TCP_IP_ADR, self.CONTROL_PORT),
+            asyncio.open_connection(self.TCP_IP_ADR, self.COUNTS_PORT))
+
+        self._labels_changed = asyncio.Condition()
+        self._new_frames = asyncio.Condition()
+        self.framer = CountsFramer()
+        self.decoder = JSONStreamDecoder()
+        self.cnts = CountsRingBuffer(capacity=self.CNTS_BUFFER, capacity_bytes=self.CNTS_BUFFER_BYTES)
+        self.n = 0
+        self.shutdown = False
+
+        self._tasks = [asyncio.ensure_future(self._run_control()),
+                       asyncio.ensure_future(self._run_counts())]
+
+        await self.send(dict(request="labelProps", value="None"))
+        self.NUMBER_OF_DETECTORS = (await self.get_label("NumberOfDetectors"))["value"]
+        #Timestamp and one column per detector, whatever the first frames looked like
+        self.framer.ncols = self.NUMBER_OF_DETECTORS + 1
+
+    async def close(self):
+        self.shutdown = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for writer in (self._ctrl_writer, self._cnts_writer):
+            writer.close()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def error(self, error_msg):
+        """Called in case of an error"""
+        print("ERROR DETECTED")
+        print(error_msg)
+
+    async def send(self, msg):
+        self._ctrl_writer.write(bytes(json.dumps(msg), "utf-8"))
+        await self._ctrl_writer.drain()
+
+    def _add_labelProps(self, data):
+        if "label" not in data:
+            return
+        if isinstance(data["value"], dict):
+            self.labelProps[data["label"]] = data["value"]
+        elif data["label"] in self.labelProps:
+            self.labelProps[data["label"]]["value"] = data["value"]
+        if "Error" in data["label"]:
+            self.error(data["value"])
+
+    async def _run_control(self):
+        try:
+            while True:
+                r = await self._ctrl_reader.read(self.BUFFER)
+                if not r:
+                    break
+                msgs = self.decoder.feed(r)
+                if not msgs:
+                    continue
+                async with self._labels_changed:
+                    for data in msgs:
+                        self._add_labelProps(data)
+                    self._labels_changed.notify_all()
+        finally:
+            self.shutdown = True
+            async with self._labels_changed:
+                self._labels_changed.notify_all()
+
+    async def _run_counts(self):
+        try:
+            while True:
+                r = await self._cnts_reader.read(self.BUFFER)
+                if not r:
+                    break
+                frames = self.framer.feed(r)
+                if len(frames) == 0:
+                    continue
+                async with self._new_frames:
+                    self.cnts.append(frames, host_time=time.time())
+                    self.n += len(frames)
+                    self._new_frames.notify_all()
+        finally:
+            self.shutdown = True
+            async with self._new_frames:
+                self._new_frames.notify_all()
+
+    async def _wait(self, cond, predicate, timeout, what):
+        def ready():
+            return predicate() or self.shutdown
+        try:
+            await asyncio.wait_for(cond.wait_for(ready), timeout)
+        except asyncio.TimeoutError:
+            raise SQTimeoutError("Timed out after %g s waiting for %s" % (timeout, what))
+        if not predicate():
+            raise IOError("Connection to %s closed" % self.TCP_IP_ADR)
+
+    async def get_label(self, label, timeout = None):
+        """Return the properties of label, waiting until the driver has sent them."""
+        if timeout is None:
+            timeout = self.LABEL_TIMEOUT
+        async with self._labels_changed:
+            await self._wait(self._labels_changed, lambda: label in self.labelProps, timeout, "label " + label)
+            return self.labelProps[label]
+
+    async def _wait_frames(self, predicate, timeout):
+        """Wait on self._new_frames like SQCounts._wait, also raising if the stream stalls."""
+        now = time.time()
+        deadline = None if timeout is None else now + timeout
+        last_n = self.n
+        last_change = now
+        while not predicate():
+            if self.shutdown:
+                raise IOError("Connection to %s closed" % self.TCP_IP_ADR)
+            now = time.time()
+            if self.n != last_n:
+                last_n = self.n
+                last_change = now
+            wait = None
+            if deadline is not None:
+                if now >= deadline:
+                    raise SQTimeoutError("Timed out after %g s waiting for count frames" % timeout)
+                wait = deadline - now
+            if self.STALL_TIMEOUT is not None:
+                stall = last_change + self.STALL_TIMEOUT - now
+                if stall <= 0:
+                    raise SQTimeoutError("No count frames received for %g s" % self.STALL_TIMEOUT)
+                wait = stall if wait is None else min(wait, stall)
+            try:
+                await asyncio.wait_for(self._new_frames.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _check_n(self, n):
+        #More frames than the buffer holds can never be returned, waiting would never end
+        if self.cnts.data is not None and n > self.cnts.capacity:
+            raise ValueError("Requested %d frames, buffer holds only %d, increase CNTS_BUFFER" % (n, self.cnts.capacity))
+
+    async def aquire_cnts(self, n, timeout = None):
+        """Aquire n count measurments.
+        Args:
+             n (int): number of count measurments
+             timeout (float): maximal waiting time in s, None waits as long as frames keep coming.
+                 Raises SQTimeoutError when exceeded or when no frame arrives for STALL_TIMEOUT s.
+        Return (numpy_array): Aquired counts with timestamp in first column,
+            one row per measurement.
+        """
+        self._check_n(n)
+        async with self._new_frames:
+            n0 = self.n
+            await self._wait_frames(lambda: (self.n >= n0+n and len(self.cnts) >= n) or
+                                    (self.cnts.data is not None and n > self.cnts.capacity), timeout)
+            self._check_n(n)
+            if self.cnts.n - len(self.cnts) > n0:
+                #Consumer too slow or buffer reallocated, oldest new frames already gone
+                return self.cnts.last(n)
+            return self.cnts.get_range(n0, n0+n)
+
+    async def set_measurement_periode(self, t_in_ms):
+        await self.send(dict(command="SetMeasurementPeriod", label="InptMeasurementPeriod", value=t_in_ms))
+
+    async def get_number_of_detectors(self):
+        return (await self.get_label("NumberOfDetectors"))["value"]
+
+    async def get_measurement_periode(self):
+        """Get measurment periode in ms.
+        Return (float): time
+        """
+        return (await self.get_label("InptMeasurementPeriod"))["value"]
+
+    async def get_bias_current(self):
+        return (await self.get_label("BiasCurrent"))["value"]
+
+    async def get_trigger_level(self):
+        return (await self.get_label("TriggerLevel"))["value"]
+
+    async def set_bias_current(self, current_in_uA):
+        await self.send(dict(command="SetAllBiasCurrents", label="BiasCurrent", value=current_in_uA))
+
+    async def set_trigger_level(self, trigger_level_mV):
+        await self.send(dict(command="SetAllTriggerLevels", label="TriggerLevel", value=trigger_level_mV))
+
+    async def enable_detectors(self, state = True):
+        await self.send(dict(command="DetectorEnable", label="DetectorEnable", value=state))
+
+if __name__ == "__main__":
+    async def main():
+        async with AsyncWebSQControl(TCP_IP_ADR="localhost") as websq:
+            await websq.set_measurement_periode(10)
+            await websq.enable_detectors(True)
+            print("N_Measurements: " + str(await websq.aquire_cnts(10)))
+            print(await websq.get_measurement_periode())
+            print(await websq.get_bias_current())
+
+    asyncio.run(main())
@@ -20,6 +20,10 @@ import numpy as np
 import re
 import ast
 import sys
+import warnings
+import collections
+import selectors
+from concurrent.futures import ThreadPoolExecutor
 #from sync import synchronized_method, synchronized_with_attr
 
 # Next part (Start -> End) based on: http://www.theorangeduck.com/page/synchronized-python 2016-June-1st
@@ -56,57 +60,222 @@ def synchronized_with_attr(lock_name):
     return decorator
 # End
 
-class SQTalk(threading.Thread):
+class SQTimeoutError(IOError):
+    """Raised when the driver does not deliver the requested data in time."""
+    pass
+
+class SQOverflowError(IOError):
+    """Raised by a counts stream with overflow="error" once frames were lost."""
+    pass
+
+class HostTime(float):
+    """A time.time() value of this computer, as opposed to a driver timestamp."""
+    pass
+
+def same_value(a, b):
+    """Compare label values, numbers and lists of numbers up to rounding."""
+    try:
+        return bool(np.allclose(np.asarray(a, dtype=float), np.asarray(b, dtype=float), rtol=1e-6, atol=1e-9))
+    except (TypeError, ValueError):
+        return a == b
+
+class JSONStreamDecoder(object):
+    """Decode the messages of the control channel.
+
+    The driver terminates every message with \x17, a message can hold
+    several concatenated JSON objects and can be split over several reads.
+    Incomplete messages are kept until the terminator arrives, messages
+    which can not be decoded are counted in malformed.
+    """
+    def __init__(self, terminator = b"\x17"):
+        self.terminator = terminator
+        self.buffer = bytearray()
+        self.decoder = json.JSONDecoder()
+        self.messages = 0
+        self.malformed = 0
+
+    def feed(self, data):
+        """Feed received bytes, return the decoded objects of all complete messages."""
+        start = len(self.buffer)
+        self.buffer += data
+        #Everything before start was searched already
+        end = self.buffer.rfind(self.terminator, max(0, start - len(self.terminator) + 1))
+        if end < 0:
+            return []
+        with memoryview(self.buffer) as view:
+            chunk = view[:end].tobytes()
+        del self.buffer[:end+len(self.terminator)]
+        objs = []
+        for msg in chunk.split(self.terminator):
+            objs.extend(self.decode(msg))
+        return objs
+
+    def decode(self, msg):
+        """Decode one message, return the list of objects in it."""
+        try:
+            text = msg.decode("utf-8")
+        except UnicodeDecodeError:
+            self.malformed += 1
+            return []
+        objs = []
+        pos = 0
+        while True:
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+            if pos == len(text):
+                break
+            try:
+                obj, pos = self.decoder.raw_decode(text, pos)
+            except ValueError:
+                self.malformed += 1
+                break
+            if isinstance(obj, dict):
+                objs.append(obj)
+                self.messages += 1
+            else:
+                self.malformed += 1
+        return objs
+
+class SQIOLoop(threading.Thread):
+    """One thread serving the sockets of all WebSQControl connections.
+
+    Sockets are registered with a callback which is called from this thread
+    whenever data can be read. The thread sleeps in select() while nothing
+    arrives and exists only once per process, no matter how many systems are
+    connected or how often they reconnect. Use SQIOLoop.instance().
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                #Daemonic Thread close when main progam is closed
+                cls._instance.daemon = True
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="SQIOLoop")
+        self.selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._calls = collections.deque()
+
+    def call(self, fn, *args):
+        """Run fn(*args) in the loop thread. Return an Event set when done."""
+        done = threading.Event()
+        if threading.current_thread() is self:
+            fn(*args)
+            done.set()
+            return done
+        self._calls.append((fn, args, done))
+        self._wakeup_w.send(b"\0")
+        return done
+
+    def register(self, sock, callback):
+        """Call callback() in the loop thread whenever sock is readable."""
+        self.call(self._register, sock, callback)
+
+    def unregister(self, sock):
+        """Stop watching sock. When this returns, callback will not be called anymore."""
+        self.call(self._unregister, sock).wait()
+
+    def _register(self, sock, callback):
+        if sock.fileno() < 0:
+            return
+        try:
+            self.selector.register(sock, selectors.EVENT_READ, callback)
+        except KeyError:
+            self.selector.modify(sock, selectors.EVENT_READ, callback)
+
+    def _unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def run(self):
+        while True:
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except socket.error:
+                        pass
+                    while self._calls:
+                        fn, args, done = self._calls.popleft()
+                        try:
+                            fn(*args)
+                        finally:
+                            done.set()
+                    continue
+                try:
+                    key.data()
+                except Exception as e:
+                    #Keep serving the other connections
+                    print("SQIOLoop: " + repr(e))
+                    self._unregister(key.fileobj)
+
+class SQTalk(object):
     def __init__(self, TCP_IP_ADR = 'localhost', TCP_IP_PORT = 12000, error_callback=None):
-        threading.Thread.__init__(self)
         self.TCP_IP_ADR  = TCP_IP_ADR
         self.TCP_IP_PORT = TCP_IP_PORT
 
         self.socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.TCP_IP_ADR, self.TCP_IP_PORT))
-        self.socket.settimeout(.1)
-        self.BUFFER =10000000
+        self.loop =SQIOLoop.instance()
+        self.BUFFER =1000000
+        #Reused for every read
+        self.rcv_buffer =memoryview(bytearray(self.BUFFER))
         self.shutdown =False
         self.labelProps = dict()
+        self.decoder = JSONStreamDecoder()
 
         self.error_callback = error_callback
+        #Timeout (s) for waiting on labels
+        self.LABEL_TIMEOUT = 10
+        #Time (s) to wait for the new value of a label after a broadcast of the old one
+        self.CONFIRM_GRACE = 0.5
 
         self.lock = threading.Lock()
+        #Notified for every label update, label_seq holds the update number per label
+        self.label_update = threading.Condition(self.lock)
+        self.seq = 0
+        self.label_seq = dict()
+        #Functions called with every new value of a label, see add_listener
+        self.listeners = collections.defaultdict(list)
+
+    def start(self):
+        self.loop.register(self.socket, self.on_readable)
+        self.send(json.dumps({"request": "labelProps", "value": "None"}))
 
     @synchronized_method
     def close(self):
         #print("Closing Socket")
+        self.loop.unregister(self.socket)
         self.socket.close()
-        self.shutdown = True
+        self._end()
+
+    def _end(self):
+        #Wake up everybody waiting for labels
+        with self.label_update:
+            self.shutdown = True
+            self.label_update.notify_all()
 
     @synchronized_method
     def send(self, msg):
         if sys.version_info.major == 3:
-            self.socket.send(bytes(msg,"utf-8"))
+            self.socket.sendall(bytes(msg,"utf-8"))
         if sys.version_info.major == 2:
-            self.socket.send(msg)
-
-    def sub_jsons(self, msg):
-        """Return sub json strings.
-        {}{} will be returned as [{},{}]
-        """
-        i = 0
-        result = []
-        split_msg = msg.split('}{')
-        for s in range(len(split_msg)):
-            if i==0 and len(split_msg)==1:
-                result.append(split_msg[s])
-            elif i==0 and len(split_msg)>1:
-                result.append(split_msg[s]+"}")
-            elif i==len(split_msg)-1 and len(split_msg)>1:
-                result.append("{"+split_msg[s])
-            else:
-                result.append("{"+split_msg[s]+"}")
-            i+=1
-        return result
+            self.socket.sendall(msg)
 
     @synchronized_method
     def add_labelProps(self, data):
+        """Store a label message. Call with self.lock held, waiters are notified."""
         if "label" in data.keys():
             #After get labelProps, queries also bounds, units etc...
             if isinstance(data["value"],(dict)):
@@ -116,7 +285,23 @@ class SQTalk(threading.Thread):
                 try:
                     self.labelProps[data["label"]]["value"]=data["value"]
                 except:
-                    None
+                    return
+            self.seq += 1
+            self.label_seq[data["label"]] = self.seq
+            for listener in self.listeners.get(data["label"], ()):
+                listener(self.labelProps[data["label"]]["value"])
+            self.label_update.notify_all()
+
+    def add_listener(self, label, listener):
+        """Call listener(value) for every update of label, also for values which are
+        replaced before a waiter wakes up. It is called in the SQIOLoop thread with
+        self.lock held and must return quickly."""
+        with self.lock:
+            self.listeners[label].append(listener)
+
+    def remove_listener(self, label, listener):
+        with self.lock:
+            self.listeners[label].remove(listener)
 
     @synchronized_method
     def check_error(self,data):
@@ -124,159 +309,882 @@ class SQTalk(threading.Thread):
             if "Error" in data["label"]:
                 self.error_callback(data["value"])
 
-    @synchronized_method
-    def get_label(self,label):
-        timeout = 10
-        dt = .1
-        i = 0
-        while True:
-            if i*dt>timeout:
-                raise IOError("Could not aquire label")
-            try:
-                return self.labelProps[label]
-                break
-            except:
-                time.sleep(dt)
-            i+=1
+    def _wait_label(self, predicate, label, timeout):
+        #Call with self.lock held
+        if timeout is None:
+            timeout = self.LABEL_TIMEOUT
+        if not self.label_update.wait_for(lambda: self.shutdown or predicate(), timeout):
+            raise SQTimeoutError("Could not aquire label " + label)
+        if not predicate():
+            raise IOError("Control connection closed")
+
+    def get_label(self, label, timeout=None):
+        """Return the cached properties of label, waiting until the driver has sent them."""
+        with self.label_update:
+            self._wait_label(lambda: label in self.labelProps, label, timeout)
+            return self.labelProps[label]
+
+    def mark(self):
+        """Return the current update number, to be used as newer_than in wait_for_update."""
+        with self.lock:
+            return self.seq
+
+    def wait_for_update(self, label, newer_than=None, value=None, timeout=None):
+        """Wait until the driver sends label.
+
+        Args:
+            label (str): label to wait for
+            newer_than (int): update number from mark(), only later updates count.
+                None waits for the next update from now on.
+            value: if given, also wait until the label has this value
+            timeout (float): in s, default self.LABEL_TIMEOUT
+        Return (dict): properties of label
+        """
+        with self.label_update:
+            if newer_than is None:
+                newer_than = self.seq
+            def updated():
+                if self.label_seq.get(label, -1) <= newer_than:
+                    return False
+                return value is None or same_value(self.labelProps[label]["value"], value)
+            self._wait_label(updated, label, timeout)
+            return self.labelProps[label]
+
+    def set_and_confirm(self, msg, label, value=None, timeout=None):
+        """Send msg (dict) and wait until the driver broadcasts label afterwards.
+
+        With value (the commanded value) a broadcast of the value before the
+        command, e.g. one already on its way, only counts if no other value
+        follows within CONFIRM_GRACE s. If the driver reports another value
+        than commanded (clipped or rounded) it is returned with a warning.
+        Return (dict): the confirmed properties of label
+        """
+        return self.set_and_confirm_many([msg], [label], timeout=timeout, values=[value])[label]
+
+    def set_and_confirm_many(self, msgs, labels, timeout=None, values=None):
+        """Send several messages (dicts) in one write and wait once until every label was broadcast.
+
+        values are the commanded values per label, see set_and_confirm.
+        Return (dict): confirmed properties per label
+        """
+        if values is None:
+            values = [None]*len(labels)
+        with self.lock:
+            seq = self.seq
+            #Values which do not confirm: the one before and the ones set earlier in msgs
+            ignore = dict((label, [self.labelProps[label]["value"]] if label in self.labelProps else [])
+                          for label in labels)
+        for msg in msgs:
+            if msg.get("label") in ignore and "value" in msg:
+                ignore[msg["label"]].append(msg["value"])
+        self.send("".join(json.dumps(msg) for msg in msgs))
+        if timeout is None:
+            timeout = self.LABEL_TIMEOUT
+        deadline = time.time() + timeout
+        result = dict()
+        for label, value in zip(labels, values):
+            result[label] = self._confirm(label, seq, value, ignore[label], max(0, deadline - time.time()))
+        return result
+
+    def _confirm(self, label, seq, value, ignore, timeout):
+        #First broadcast of label after update seq which is value or none of the ignored ones
+        def updated():
+            return self.label_seq.get(label, -1) > seq
+        def changed():
+            if not updated():
+                return False
+            current = self.labelProps[label]["value"]
+            return value is None or same_value(current, value) or \
+                not any(same_value(current, v) for v in ignore)
+        deadline = time.time() + timeout
+        with self.label_update:
+            self._wait_label(updated, label, timeout)
+            if not changed():
+                #Sent before the command, or the driver adjusted the value back to an ignored one
+                try:
+                    self._wait_label(changed, label, min(self.CONFIRM_GRACE, max(0, deadline - time.time())))
+                except SQTimeoutError:
+                    pass
+            props = self.labelProps[label]
+        if value is not None and not same_value(props["value"], value):
+            warnings.warn("%s commanded %r, driver set %r" % (label, value, props["value"]))
+        return props
 
     @synchronized_method
     def get_all_labels(self,label):
         return self.labelProps
 
-    def run(self):
+    def on_readable(self):
+        """Called by the SQIOLoop when data arrived."""
+        try:
+            nbytes =self.socket.recv_into(self.rcv_buffer)
+        except socket.error:
+            nbytes =0
+        if nbytes == 0:
+            #Connection lost
+            self.loop.unregister(self.socket)
+            self._end()
+            return
 
-        self.send(json.dumps({"request": "labelProps", "value": "None"}))
-        rcv_msg=[]
+        msgs = self.decoder.feed(self.rcv_buffer[:nbytes])
+        if not msgs:
+            return
+
+        with self.lock:
+            for data in msgs:
+                self.add_labelProps(data)
+                self.check_error(data)
+
+class CountsRingBuffer(object):
+    """Fixed capacity ring buffer holding count frames.
+
+    Every frame is one row: the timestamp in the first column followed by
+    one column per detector. The storage is allocated once, on the first
+    frame, and afterwards frames are written in place. Next to the frames the
+    host time at which they were received is kept.
+
+    Args:
+        capacity (int): number of frames to keep
+        capacity_bytes (int): if given, the number of frames is derived from
+            this memory budget instead of from capacity
+    """
+    def __init__(self, capacity = 100, capacity_bytes = None, dtype = np.float64):
+        self.capacity = capacity
+        self.capacity_bytes = capacity_bytes
+        self.dtype = np.dtype(dtype)
+        self.data = None
+        #Absolute index of the next frame, never reset
+        self.n = 0
+        #Absolute index of the first frame in the current storage
+        self.first = 0
+
+    def _allocate(self, ncols):
+        if self.capacity_bytes is not None:
+            self.capacity = max(1, int(self.capacity_bytes // (ncols*self.dtype.itemsize)))
+        self.data = np.zeros((self.capacity, ncols), dtype=self.dtype)
+        self.host_times = np.zeros(self.capacity)
+        #Older frames are dropped, the indices of the following ones stay valid
+        self.first = self.n
+
+    @property
+    def ncols(self):
+        if self.data is None:
+            return 0
+        return self.data.shape[1]
+
+    def __len__(self):
+        return min(self.n - self.first, self.capacity)
+
+    def append(self, frames, host_time = None):
+        """Append one frame (1-D) or several frames (2-D) to the buffer.
+
+        host_time (float): time.time() when the frames were received
+        """
+        frames = np.asarray(frames, dtype=self.dtype)
+        if frames.ndim == 1:
+            frames = frames[np.newaxis, :]
+        if self.data is None or frames.shape[1] != self.ncols:
+            #Number of detectors changed, start over with the new frames
+            self._allocate(frames.shape[1])
+        k = len(frames)
+        if k > self.capacity:
+            self.n += k - self.capacity
+            frames = frames[k-self.capacity:]
+            k = self.capacity
+        start = self.n % self.capacity
+        first = min(k, self.capacity - start)
+        self.data[start:start+first] = frames[:first]
+        self.host_times[start:start+first] = host_time or 0.
+        if first < k:
+            self.data[:k-first] = frames[first:]
+            self.host_times[:k-first] = host_time or 0.
+        self.n += k
+
+    def get_range(self, start, stop, copy = True):
+        """Return frames with absolute index start <= i < stop.
+
+        A contiguous range is returned as a view if copy is False, a wrapped
+        range always costs exactly one copy.
+        """
+        if start < self.n - len(self) or stop > self.n or start > stop:
+            raise IndexError("Frames %d to %d not in buffer" % (start, stop))
+        if self.data is None:
+            return np.zeros((0, 0), dtype=self.dtype)
+        a = start % self.capacity
+        b = a + (stop - start)
+        if b <= self.capacity:
+            frames = self.data[a:b]
+            return frames.copy() if copy else frames
+        return np.concatenate((self.data[a:], self.data[:b-self.capacity]))
+
+    def get_host_times(self, start, stop):
+        """Return the receive times of the frames start <= i < stop."""
+        self.get_range(start, stop, copy=False)
+        if self.data is None:
+            return np.zeros(0)
+        return self.host_times[np.arange(start, stop) % self.capacity]
+
+    def last(self, n, copy = True):
+        """Return the last n frames as a 2-D array."""
+        if n > self.capacity:
+            raise ValueError("Requested %d frames, buffer holds only %d" % (n, self.capacity))
+        return self.get_range(self.n - n, self.n, copy=copy)
+
+    def index_after(self, t, column = 0):
+        """Absolute index of the first buffered frame with column value > t.
+
+        Assumes the column (by default the timestamp) is increasing, column
+        None compares the host receive times instead. Returns self.n if no
+        buffered frame is newer than t.
+        """
+        k = len(self)
+        if k == 0:
+            return self.n
+        values = self.host_times if column is None else self.data[:, column]
+        lo = self.n - k
+        a = lo % self.capacity
+        first = values[a:a+min(k, self.capacity-a)]
+        i = int(np.searchsorted(first, t, side='right'))
+        if i < len(first):
+            return lo + i
+        second = values[:k-len(first)]
+        return lo + len(first) + int(np.searchsorted(second, t, side='right'))
+
+class ChannelStats(object):
+    """Running statistics per detector channel over all frames seen.
+
+    Mean and variance are merged batch by batch (Welford / Chan et al.), so
+    no samples are stored and a query costs O(channels).
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.total = None
+
+    def update(self, counts):
+        """Add a 2-D array of counts, one row per frame, one column per channel."""
+        k = len(counts)
+        if k == 0:
+            return
+        mean = counts.mean(axis=0)
+        m2 = ((counts - mean)**2).sum(axis=0)
+        if self.n == 0 or len(mean) != len(self.mean):
+            self.n = k
+            self.mean = mean
+            self.m2 = m2
+            self.min = counts.min(axis=0)
+            self.max = counts.max(axis=0)
+            self.total = counts.sum(axis=0)
+            return
+        n = self.n + k
+        delta = mean - self.mean
+        self.mean = self.mean + delta*(k/float(n))
+        self.m2 = self.m2 + m2 + delta**2*(self.n*k/float(n))
+        self.min = np.minimum(self.min, counts.min(axis=0))
+        self.max = np.maximum(self.max, counts.max(axis=0))
+        self.total = self.total + counts.sum(axis=0)
+        self.n = n
+
+    def snapshot(self):
+        """Return a DICT with frames, mean, std, sem (standard error of the mean),
+        min, max and total counts per channel."""
+        if self.n == 0:
+            return dict(frames=0, mean=None, std=None, sem=None, min=None, max=None, total=None)
+        var = self.m2/(self.n - 1) if self.n > 1 else np.zeros_like(self.m2)
+        std = np.sqrt(var)
+        return dict(frames=self.n, mean=self.mean.copy(), std=std, sem=std/np.sqrt(self.n),
+                    min=self.min.copy(), max=self.max.copy(), total=self.total.copy())
+
+class CountsFramer(object):
+    """Split the counts stream into frames.
 
-        while self.shutdown == False:
+    The driver sends one frame per line, comma separated, timestamp first.
+    A read can contain several frames and a frame can be split over two
+    reads, so incomplete lines are kept until the rest arrives.
+
+    All frames have ncols columns. If ncols is not given it is taken from
+    the first frames received (the most common width among them), lines
+    with another number of columns are counted in malformed and dropped.
+
+    Received data goes into one preallocated buffer: socket.recv_into(free())
+    followed by commit(nbytes), or feed(data) for data read elsewhere.
+    """
+    NO_FRAMES = np.zeros((0, 0))
+
+    def __init__(self, size = 1000000, ncols = None):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        #Scratch space to find newlines and commas without allocating
+        self.bytes = np.frombuffer(self.buffer, dtype=np.uint8)
+        self.mask = np.zeros(size, dtype=bool)
+        #Bytes of an incomplete frame at the start of the buffer
+        self.end = 0
+        self.ncols = ncols
+        self.malformed = 0
+
+    @property
+    def partial(self):
+        return self.view[:self.end].tobytes()
+
+    def free(self):
+        """Writable memoryview of the unused part of the buffer."""
+        if self.end == len(self.buffer):
+            #A single line longer than the buffer, grow
+            self._grow(2*len(self.buffer))
+        return self.view[self.end:]
+
+    def _grow(self, size):
+        old = self.buffer
+        self.view.release()
+        self.buffer = bytearray(size)
+        self.buffer[:self.end] = old[:self.end]
+        self.view = memoryview(self.buffer)
+        self.bytes = np.frombuffer(self.buffer, dtype=np.uint8)
+        self.mask = np.zeros(size, dtype=bool)
+
+    def feed(self, data):
+        """Feed received bytes, return all complete frames as a 2-D float array."""
+        data = memoryview(data)
+        frames = []
+        while len(data):
+            free = self.free()
+            k = min(len(free), len(data))
+            free[:k] = data[:k]
+            data = data[k:]
+            f = self.commit(k)
+            if len(f):
+                frames.append(f)
+        if not frames:
+            return self.NO_FRAMES
+        if len(frames) == 1:
+            return frames[0]
+        return np.vstack(frames)
+
+    def commit(self, nbytes):
+        """nbytes were written into free(), return all complete frames as a 2-D float array."""
+        start = self.end
+        self.end += nbytes
+        last = self.buffer.rfind(b"\n", start, self.end)
+        if last < 0:
+            return self.NO_FRAMES
+        frames = self.parse(last)
+        #Move the incomplete frame to the start of the buffer
+        tail = self.end - last - 1
+        self.view[:tail] = self.view[last+1:self.end]
+        self.end = tail
+        return frames
+
+    def parse(self, last):
+        """Parse the newline separated frames in buffer[:last] in one vectorized call."""
+        if self.ncols is None:
+            return self._parse_lines(self.view[:last].tobytes())
+        raw = self.bytes[:last]
+        mask = self.mask[:last]
+        np.equal(raw, 10, out=mask)
+        newlines = np.flatnonzero(mask)
+        ends = np.append(newlines, last)
+        #Every line must hold ncols-1 commas, otherwise the slow path sorts them out
+        np.equal(raw, 44, out=mask)
+        commas = np.flatnonzero(mask)
+        per_line = self.ncols - 1
+        if len(commas) != len(ends)*per_line or \
+                not np.array_equal(np.searchsorted(commas, ends), per_line*np.arange(1, len(ends)+1)):
+            return self._parse_lines(self.view[:last].tobytes())
+        #Frames become one comma separated list, parsed straight from the buffer
+        raw[newlines] = 44
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
             try:
-                rcv=""+rcv_msg[1]
+                values = np.fromstring(self.view[:last].tobytes(), dtype=np.float64, sep=",")
+            except (ValueError, DeprecationWarning):
+                values = None
+        if values is not None and values.size == len(ends)*self.ncols:
+            return values.reshape(len(ends), self.ncols)
+        raw[newlines] = 10
+        return self._parse_lines(self.view[:last].tobytes())
 
-            except:
-                rcv=""
-            data = {}
-            r=""
-            while "\x17" not in rcv:
+    def _parse_lines(self, chunk):
+        #Slow path, only used if the chunk contains broken frames or empty lines
+        rows = []
+        for line in chunk.split(b"\n"):
+            line = line.strip()
+            if not line:
+                continue
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
                 try:
-                    if sys.version_info.major == 3:
-                        r =str(self.socket.recv(self.BUFFER),'utf-8')
-                    elif sys.version_info.major == 2:
-                        r =self.socket.recv(self.BUFFER)
-                except:
-                    None
-                rcv = rcv + r
+                    v = np.fromstring(line, dtype=np.float64, sep=",")
+                except (ValueError, DeprecationWarning):
+                    v = None
+            if v is None or v.size == 0:
+                self.malformed += 1
+                continue
+            rows.append(v)
+        if self.ncols is None and rows:
+            #First frames of the stream, a single broken line can not decide the width
+            self.ncols = collections.Counter(v.size for v in rows).most_common(1)[0][0]
+        frames = [v for v in rows if v.size == self.ncols]
+        self.malformed += len(rows) - len(frames)
+        if not frames:
+            return self.NO_FRAMES
+        return np.vstack(frames)
 
-            rcv_msg =rcv.split("\x17")
+class CountsSubscription(object):
+    """Bounded queue delivering every count frame of a SQCounts stream in order.
 
-            for rcv_line in rcv_msg:
-                rcv_split = self.sub_jsons(rcv_line)
-                for msg in rcv_split:
-                    try:
-                        data = json.loads(msg)
-                    except Exception as e:
-                        None
+    Iterating yields 2-D arrays (timestamp in first column) in the batches
+    they were received in, use frames() to iterate frame by frame. What
+    happens if the consumer falls more than maxsize frames behind is set by
+    overflow:
+        "block"       reading the socket pauses, nothing is lost
+        "drop-oldest" the oldest queued frames are discarded and counted in dropped
+        "error"       new frames are discarded and the iteration raises SQOverflowError
+
+    Args:
+        maxsize (int): maximal number of queued frames
+        overflow (str): "block", "drop-oldest" or "error"
+        timeout (float): maximal time to wait for the next batch in s, None waits forever
+    """
+    OVERFLOW_POLICIES = ("block", "drop-oldest", "error")
+
+    def __init__(self, maxsize = 10000, overflow = "block", timeout = None):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of " + ", ".join(self.OVERFLOW_POLICIES))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.timeout = timeout
+        self.queue = collections.deque()
+        self.size = 0
+        self.cond = threading.Condition()
+        #Loss counters, all in frames
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.overflowed = False
+        self.ended = False
+        self.cancelled = False
+        self.full = False
+        self.on_cancel = None
+        self.on_space = None
+
+    def offer(self, frames):
+        """Queue frames, called by the ingestion thread.
+
+        Never waits. Returns False if the queue is full with overflow="block",
+        the frames are then not taken and on_space is called once there is room.
+        """
+        k = len(frames)
+        with self.cond:
+            if self.cancelled:
+                return True
+            if self.overflow == "block" and self.size > 0 and self.size + k > self.maxsize:
+                self.full = True
+                return False
+            self.received += k
+            if self.overflow == "error" and (self.overflowed or self.size + k > self.maxsize):
+                self.overflowed = True
+                self.dropped += k
+                self.cond.notify_all()
+                return True
+            self.queue.append(frames)
+            self.size += k
+            while self.overflow == "drop-oldest" and self.size > self.maxsize:
+                #Trim the oldest batch
+                oldest = self.queue[0]
+                excess = self.size - self.maxsize
+                if len(oldest) <= excess:
+                    self.queue.popleft()
+                    excess = len(oldest)
+                else:
+                    self.queue[0] = oldest[excess:]
+                self.size -= excess
+                self.dropped += excess
+            self.cond.notify_all()
+            return True
+
+    def end(self):
+        """No more frames will come, called when the stream closes."""
+        with self.cond:
+            self.ended = True
+            self.cond.notify_all()
+
+    def get(self, timeout = None):
+        """Return the next batch of frames, None once the stream has ended."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.queue or self.ended or self.cancelled or self.overflowed,
+                                      timeout):
+                raise SQTimeoutError("No count frames received for %g s" % timeout)
+            if self.queue:
+                frames = self.queue.popleft()
+                self.size -= len(frames)
+                self.delivered += len(frames)
+                resume = self.full
+                self.full = False
+            elif self.overflowed:
+                raise SQOverflowError("Counts stream overflowed, %d frames lost" % self.dropped)
+            else:
+                return None
+        if resume and self.on_space is not None:
+            self.on_space(self)
+        return frames
+
+    def close(self):
+        """Stop receiving frames and release a blocked ingestion thread."""
+        with self.cond:
+            self.cancelled = True
+            self.queue.clear()
+            self.size = 0
+            self.cond.notify_all()
+        if self.on_cancel is not None:
+            self.on_cancel(self)
 
-                    with self.lock:
-                        self.add_labelProps(data)
-                        self.check_error(data)
+    def __iter__(self):
+        return self
 
-class SQCounts(threading.Thread):
-    def __init__(self, TCP_IP_ADR = 'localhost', TCP_IP_PORT = 12345, CNTS_BUFFER =100):
-        threading.Thread.__init__(self)
+    def __next__(self):
+        frames = self.get(self.timeout)
+        if frames is None:
+            raise StopIteration
+        return frames
+
+    next = __next__
+
+    def frames(self):
+        """Iterate frame by frame instead of batch by batch."""
+        for batch in self:
+            for frame in batch:
+                yield frame
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SQCounts(object):
+    def __init__(self, TCP_IP_ADR = 'localhost', TCP_IP_PORT = 12345, CNTS_BUFFER =100, CNTS_BUFFER_BYTES = None):
         self.lock =threading.Lock()
         self.rlock =threading.RLock()
+        #Notified by the ingestion thread for every new frame
+        self.new_frames =threading.Condition(self.lock)
         self.TCP_IP_ADR  = TCP_IP_ADR
         self.TCP_IP_PORT = TCP_IP_PORT
 
         self.socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.TCP_IP_ADR, self.TCP_IP_PORT))
-        #self.socket.settimeout(.1)
+        self.loop =SQIOLoop.instance()
         self.BUFFER =1000000
         self.shutdown =False
+        #Raise if no frame arrives for this long (s) while waiting, None waits forever
+        self.STALL_TIMEOUT =10
 
-        self.cnts =[]
+        self.framer =CountsFramer(self.BUFFER)
+        self.cnts =CountsRingBuffer(capacity=CNTS_BUFFER, capacity_bytes=CNTS_BUFFER_BYTES)
         self.CNTS_BUFFER =CNTS_BUFFER
         self.n = 0
+        self.subscriptions =[]
+        #Frames not yet taken by full blocking subscriptions, reading is paused meanwhile
+        self.pending =None
+        #ChannelStats, None while disabled
+        self.stats =None
+
+    def start(self):
+        self.loop.register(self.socket, self.on_readable)
 
     @synchronized_method
     def close(self):
         #print("Closing Socket")
+        self.loop.unregister(self.socket)
         self.socket.close()
-        self.shutdown =True
+        self._end()
 
-    @synchronized_method
-    def get_n(self, n):
-        n0 = self.n
-        while self.n <= n0+n:
-            time.sleep(0.001)
-        cnts = self.cnts
-        return cnts[-n:]
+    def _end(self):
+        with self.new_frames:
+            self.shutdown =True
+            self.new_frames.notify_all()
+            subscriptions =list(self.subscriptions)
+        for sub in subscriptions:
+            sub.end()
 
-    def run(self):
-        data=[]
-        while self.shutdown == False:
-            if sys.version_info.major == 3:
-                data_raw =str(self.socket.recv(self.BUFFER),'utf-8')
-            elif sys.version_info.major == 2:
-                data_raw =self.socket.recv(self.BUFFER)
-
-            data_newline =data_raw.split('\n')
-
-            v =[]
-            for d in data_newline[0].split(','):
-                v.append(float(d))
-
-            with self.lock:
-                self.cnts.append(np.array(v))
-                #Keep Size of self.cnts
-                l = len(self.cnts)
-                if l>self.CNTS_BUFFER:
-                    self.cnts =self.cnts[l-self.CNTS_BUFFER:]
-                self.n += 1
+    def subscribe(self, maxsize = 10000, overflow = "block", timeout = None):
+        """Return a CountsSubscription receiving every frame from now on."""
+        sub = CountsSubscription(maxsize=maxsize, overflow=overflow, timeout=timeout)
+        sub.on_cancel = self.unsubscribe
+        sub.on_space = self._resume
+        with self.new_frames:
+            if self.shutdown:
+                sub.end()
+            self.subscriptions.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.new_frames:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+        self._resume(sub)
+
+    def enable_stats(self, enable = True):
+        """Keep running statistics of every channel (see ChannelStats), starting now."""
+        with self.new_frames:
+            self.stats = ChannelStats() if enable else None
+
+    def get_stats(self, reset = False):
+        """Return ChannelStats.snapshot(), with reset=True atomically start over."""
+        with self.new_frames:
+            if self.stats is None:
+                raise ValueError("Statistics not enabled, call enable_stats() first")
+            snapshot = self.stats.snapshot()
+            if reset:
+                self.stats.reset()
+            return snapshot
+
+    def _wait(self, predicate, timeout):
+        """Wait on self.new_frames until predicate() is true. Call with self.lock held."""
+        now = time.time()
+        deadline = None if timeout is None else now + timeout
+        last_n = self.n
+        last_change = now
+        while not predicate():
+            if self.shutdown:
+                raise IOError("Counts stream closed")
+            now = time.time()
+            if self.n != last_n:
+                last_n = self.n
+                last_change = now
+            wait = None
+            if deadline is not None:
+                if now >= deadline:
+                    raise SQTimeoutError("Timed out after %g s waiting for count frames" % timeout)
+                wait = deadline - now
+            if self.STALL_TIMEOUT is not None:
+                stall = last_change + self.STALL_TIMEOUT - now
+                if stall <= 0:
+                    raise SQTimeoutError("No count frames received for %g s" % self.STALL_TIMEOUT)
+                wait = stall if wait is None else min(wait, stall)
+            self.new_frames.wait(wait)
+
+    def _check_n(self, n):
+        #More frames than the buffer holds can never be returned, waiting would never end
+        if self.cnts.data is not None and n > self.cnts.capacity:
+            raise ValueError("Requested %d frames, buffer holds only %d, use a stream" % (n, self.cnts.capacity))
+
+    def get_n(self, n, timeout = None, host_times = False):
+        """Wait for n new frames and return them as a 2-D array (timestamp in first column).
+
+        Args:
+            n (int): number of frames
+            timeout (float): maximal time to wait in s, None waits as long as frames keep coming
+            host_times (bool): also return the host receive time of every frame
+        Raises SQTimeoutError if the frames do not arrive in time.
+        The frames are a copy, the buffer is overwritten by the SQIOLoop thread.
+        """
+        self._check_n(n)
+        with self.new_frames:
+            n0 = self.n
+            self._wait(lambda: (self.n >= n0+n and len(self.cnts) >= n) or
+                       (self.cnts.data is not None and n > self.cnts.capacity), timeout)
+            self._check_n(n)
+            if self.cnts.n - len(self.cnts) > n0:
+                #Consumer too slow or buffer reallocated, oldest new frames already gone
+                n0 = self.cnts.n - n
+            frames = self.cnts.get_range(n0, n0+n)
+            if host_times:
+                return frames, self.cnts.get_host_times(n0, n0+n)
+            return frames
+
+    def get_after(self, t, n = 1, timeout = None, host = False, host_times = False):
+        """Wait for n frames with a timestamp newer than t and return them.
+
+        Args:
+            t (float): driver timestamp, or host time.time() if host is True
+            n (int): number of frames
+            timeout (float): maximal time to wait in s
+            host_times (bool): also return the host receive time of every frame
+        """
+        self._check_n(n)
+        column = None if host else 0
+        def ready():
+            #The buffer size is only known after the first frame
+            return (self.cnts.data is not None and n > self.cnts.capacity) or \
+                self.cnts.n - self.cnts.index_after(t, column) >= n
+        with self.new_frames:
+            self._wait(ready, timeout)
+            self._check_n(n)
+            start = self.cnts.index_after(t, column)
+            frames = self.cnts.get_range(start, start+n)
+            if host_times:
+                return frames, self.cnts.get_host_times(start, start+n)
+            return frames
+
+    def on_readable(self):
+        """Called by the SQIOLoop when data arrived."""
+        try:
+            nbytes =self.socket.recv_into(self.framer.free())
+        except socket.error:
+            nbytes =0
+        if nbytes == 0:
+            #Connection lost, wake up everybody waiting for frames
+            self.loop.unregister(self.socket)
+            self._end()
+            return
+
+        frames =self.framer.commit(nbytes)
+        if len(frames) == 0:
+            return
+
+        with self.new_frames:
+            self.cnts.append(frames, host_time=time.time())
+            self.n += len(frames)
+            if self.stats is not None:
+                self.stats.update(frames[:, 1:])
+            self.new_frames.notify_all()
+            subscriptions =list(self.subscriptions)
+        self._deliver(frames, subscriptions)
+
+    def _deliver(self, frames, subscriptions):
+        #Runs in the loop thread. Pause reading while a blocking subscription is full.
+        waiting = [sub for sub in subscriptions if not sub.offer(frames)]
+        if waiting:
+            self.pending = (frames, waiting)
+            self.loop.unregister(self.socket)
+        else:
+            self.pending = None
+
+    def _resume(self, sub):
+        self.loop.call(self._retry)
+
+    def _retry(self):
+        if self.pending is None or self.shutdown:
+            return
+        frames, waiting = self.pending
+        with self.new_frames:
+            waiting = [sub for sub in waiting if sub in self.subscriptions]
+        self._deliver(frames, waiting)
+        if self.pending is None:
+            self.loop.register(self.socket, self.on_readable)
 
 class WebSQControl(object):
-    def __init__(self, TCP_IP_ADR = 'localhost', CONTROL_PORT = 12000, COUNTS_PORT = 12345):
+    def __init__(self, TCP_IP_ADR = 'localhost', CONTROL_PORT = 12000, COUNTS_PORT = 12345, CNTS_BUFFER = 100, CNTS_BUFFER_BYTES = None):
         self.TCP_IP_ADR  = TCP_IP_ADR
         self.CONTROL_PORT = CONTROL_PORT
         self.COUNTS_PORT = COUNTS_PORT
+        self.CNTS_BUFFER = CNTS_BUFFER
+        self.CNTS_BUFFER_BYTES = CNTS_BUFFER_BYTES
         self.NUMBER_OF_DETECTORS = 0
+        #Seconds per unit of the timestamp column, the driver counts in ms
+        self.TIMESTAMP_UNIT = 1e-3
+        #Seconds between StartAutoIV requests while no broadcast arrives
+        self.AUTOIV_POLL = 1.
+        self._calibration = None
 
     def connect(self):
+        #Both sockets are served by the shared SQIOLoop thread
         self.talk = SQTalk(TCP_IP_ADR=self.TCP_IP_ADR,  TCP_IP_PORT = self.CONTROL_PORT, error_callback = self.error)
-        #Daemonic Thread close when main progam is closed
-        self.talk.daemon =True
         self.talk.start()
 
-        self.cnts =SQCounts(TCP_IP_ADR=self.TCP_IP_ADR, TCP_IP_PORT=self.COUNTS_PORT)
-        #Daemonic Thread close when main progam is closed
-        self.cnts.daemon =True
+        self.cnts =SQCounts(TCP_IP_ADR=self.TCP_IP_ADR, TCP_IP_PORT=self.COUNTS_PORT,
+                            CNTS_BUFFER=self.CNTS_BUFFER, CNTS_BUFFER_BYTES=self.CNTS_BUFFER_BYTES)
         self.cnts.start()
 
         self.NUMBER_OF_DETECTORS = self.talk.get_label("NumberOfDetectors")["value"]
+        #Timestamp and one column per detector, whatever the first frames looked like
+        self.cnts.framer.ncols = self.NUMBER_OF_DETECTORS + 1
 
 
     def close(self):
+        #Returns once the sockets are removed from the SQIOLoop
         self.talk.close()
-        #self.talk.join()
         self.cnts.close()
-        #self.cnts.join()
+        if self._calibration is not None:
+            self._calibration.shutdown(wait=False)
+            self._calibration = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def error(self, error_msg):
         """Called in case of an error"""
         print("ERROR DETECTED")
         print(error_msg)
 
-    def aquire_cnts(self,n):
+    def aquire_cnts(self,n, timeout=None, after=None, settle=0, host_times=False):
         """Aquire n count measurments.
         Args:
              n (int): number of count measurments
-        Return (numpy_array): Aquired counts with timestamp in first column.
+             timeout (float): maximal waiting time in s, raises SQTimeoutError when exceeded
+             after: only use measurements which started after this moment, e.g. a state change.
+                 Either a driver timestamp (float, as in the first column), a
+                 HostTime(time.time()) or a threading.Event (the moment it is set).
+                 None takes the next n measurements.
+             settle (float): additional time in s after the moment given by after
+             host_times (bool): also return the time.time() at which every measurement
+                 was received, to relate the counts to other instruments
+        Return (numpy_array): Aquired counts with timestamp in first column,
+            one row per measurement. With host_times a tuple (counts, host times).
         """
-        return self.cnts.get_n(n)
+        if after is None:
+            return self.cnts.get_n(n, timeout=timeout, host_times=host_times)
+        if isinstance(after, threading.Event):
+            if not after.wait(timeout):
+                raise SQTimeoutError("Timed out after %g s waiting for the event" % timeout)
+            after = HostTime(time.time())
+        #A measurement reported within one period after the moment started before it
+        delay = settle + self.get_measurement_periode()*1e-3
+        if isinstance(after, HostTime):
+            return self.cnts.get_after(after + delay, n, timeout=timeout, host=True, host_times=host_times)
+        return self.cnts.get_after(after + delay/self.TIMESTAMP_UNIT, n, timeout=timeout, host_times=host_times)
 
-    def set_measurement_periode(self, t_in_ms):
-        msg = json.dumps(dict(command="SetMeasurementPeriod", label= "InptMeasurementPeriod", value=t_in_ms))
-        self.talk.send(msg)
+    def stream_counts(self, maxsize = 10000, overflow = "block", timeout = None):
+        """Stream every count measurement from now on, without losing frames.
+
+        Use as
+            with websq.stream_counts() as stream:
+                for cnts in stream:
+                    ...
+        Every cnts is a numpy array with timestamp in first column, one row per measurement.
+        Args:
+             maxsize (int): maximal number of frames queued for the consumer
+             overflow (str): what to do if the consumer falls behind, "block", "drop-oldest" or "error"
+             timeout (float): maximal time to wait for new frames in s, raises SQTimeoutError when exceeded
+        Return (CountsSubscription): iterator over the frames, with loss counters
+            received, delivered and dropped.
+        """
+        return self.cnts.subscribe(maxsize=maxsize, overflow=overflow, timeout=timeout)
+
+    def enable_stats(self, enable = True):
+        """Keep running per-channel statistics of all frames from now on, without storing them."""
+        self.cnts.enable_stats(enable)
+
+    def count_stats(self, reset = False):
+        """Statistics per detector since enable_stats() or the last reset.
+        Return (dict): frames, mean, std, sem, min, max and total counts, arrays with one value per detector.
+        """
+        return self.cnts.get_stats(reset=reset)
+
+    def _set(self, msg, confirm, timeout=None):
+        #Send a command, with confirm wait for the driver to broadcast the new value
+        if confirm:
+            return self.talk.set_and_confirm(msg, msg["label"], value=msg["value"], timeout=timeout)["value"]
+        self.talk.send(json.dumps(msg))
+
+    def batch(self, confirm=True, timeout=None):
+        """Return a CommandBatch sending several setters in one write and confirming them together."""
+        return CommandBatch(self, confirm=confirm, timeout=timeout)
+
+    def set_measurement_periode(self, t_in_ms, confirm=False):
+        """Set the measurement periode in ms.
+        With confirm=True wait until the driver reports the change and return the new value.
+        """
+        return self._set(dict(command="SetMeasurementPeriod", label= "InptMeasurementPeriod", value=t_in_ms), confirm)
 
     def get_number_of_detectors(self):
         return self.talk.get_label("NumberOfDetectors")["value"]
@@ -294,23 +1202,25 @@ class WebSQControl(object):
         return self.talk.get_label("TriggerLevel")["value"]
 
     def get_bias_voltage(self):
-        msg = json.dumps(dict(request="BiasVoltage"))
-        self.talk.send(msg)
-        return self.talk.get_label("BiasVoltage")["value"]
+        #Wait for the answer to this request, not a value cached before
+        return self.talk.set_and_confirm(dict(request="BiasVoltage"), "BiasVoltage")["value"]
 
-    def set_bias_current(self, current_in_uA):
+    def set_bias_current(self, current_in_uA, confirm=False):
+        """Set the bias current of all detectors in uA.
+        With confirm=True wait until the driver reports the change and return the new value.
+        """
         array = current_in_uA
-        msg = json.dumps(dict(command="SetAllBiasCurrents", label= "BiasCurrent", value=array))
-        self.talk.send(msg)
+        return self._set(dict(command="SetAllBiasCurrents", label= "BiasCurrent", value=array), confirm)
 
-    def set_trigger_level(self, trigger_level_mV):
+    def set_trigger_level(self, trigger_level_mV, confirm=False):
+        """Set the trigger level of all detectors in mV.
+        With confirm=True wait until the driver reports the change and return the new value.
+        """
         array = trigger_level_mV
-        msg =json.dumps(dict(command="SetAllTriggerLevels", label= "TriggerLevel", value=array))
-        self.talk.send(msg)
+        return self._set(dict(command="SetAllTriggerLevels", label= "TriggerLevel", value=array), confirm)
 
-    def enable_detectors(self,state = True):
-        msg = json.dumps(dict(command="DetectorEnable", label="DetectorEnable", value=state))
-        self.talk.send(msg)
+    def enable_detectors(self,state = True, confirm=False):
+        return self._set(dict(command="DetectorEnable", label="DetectorEnable", value=state), confirm)
 
     def set_dark_counts_auto_iv(self, dark_counts):
         """
@@ -336,9 +1246,124 @@ class WebSQControl(object):
         Check if auto calibration of the bias currents to find a given dark count value has finished.
         Returns: True if finished, False otherwise
         """
-        msg =json.dumps(dict(request="StartAutoIV"))
-        self.talk.send(msg)
-        return not(self.talk.get_label("StartAutoIV")["value"])
+        return not(self.talk.set_and_confirm(dict(request="StartAutoIV"), "StartAutoIV")["value"])
+
+    def auto_calibrate(self, dark_counts = None, timeout = None):
+        """
+        Start the automatic bias calibration without waiting for it.
+        Make sure that no light reaches the detectors during this procedure.
+
+        The driver broadcasts StartAutoIV when the calibration starts and ends, so
+        no polling is needed; only if no broadcast arrives for AUTOIV_POLL s the
+        state is requested, and the calibration has finished once it is False.
+        Several systems can be calibrated at the same time:
+            futures = [websq.auto_calibrate(dark) for websq in systems]
+            currents = [f.result() for f in futures]
+        In asyncio code use: await asyncio.wrap_future(websq.auto_calibrate(dark))
+        Args:
+             dark_counts (list): dark counts (Hz) per detector to calibrate to,
+                 None keeps the values set before
+             timeout (float): maximal calibration time in s, None waits forever
+        Return (concurrent.futures.Future): result is the list of calibrated bias
+            currents in uA, or SQTimeoutError
+        """
+        if dark_counts is not None and self.NUMBER_OF_DETECTORS != len(dark_counts):
+            raise ValueError('Dark counts not the same lenght as number of detectors')
+        if self._calibration is None:
+            self._calibration = ThreadPoolExecutor(max_workers=1)
+        return self._calibration.submit(self._auto_calibrate, dark_counts, timeout)
+
+    def _auto_calibrate(self, dark_counts, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        msgs = []
+        if dark_counts is not None:
+            msgs.append(dict(command="DarkCountsAutoIV", label="DarkCountsAutoIV", value=dark_counts))
+        msgs.append(dict(command="AutoCaliBiasCurrents", value=True))
+        #Every StartAutoIV value from now on: a short run may broadcast True and
+        #False before this thread wakes up, so the latest value alone is not enough.
+        #A driver which does not broadcast may have finished before the first
+        #request, False in an answer to a request sent after the command also counts.
+        states = []
+        polled = []
+        def finished():
+            if not states or states[-1]:
+                return False
+            return True in states or (polled and len(states) > polled[0])
+        self.talk.add_listener("StartAutoIV", states.append)
+        try:
+            self.talk.send("".join(json.dumps(msg) for msg in msgs))
+            while True:
+                poll = self.AUTOIV_POLL
+                if deadline is not None:
+                    poll = min(poll, deadline - time.time())
+                    if poll <= 0:
+                        raise SQTimeoutError("Auto calibration not finished after %g s" % timeout)
+                try:
+                    with self.talk.label_update:
+                        self.talk._wait_label(finished, "StartAutoIV", poll)
+                    break
+                except SQTimeoutError:
+                    #No broadcast, ask for the state
+                    if not polled:
+                        with self.talk.lock:
+                            polled.append(len(states))
+                    self.talk.send(json.dumps(dict(request="StartAutoIV")))
+        finally:
+            self.talk.remove_listener("StartAutoIV", states.append)
+        return self.talk.set_and_confirm(dict(request="BiasCurrent"), "BiasCurrent")["value"]
+
+class CommandBatch(object):
+    """Collect several commands and send them to the driver in one write.
+
+    Use as
+        with websq.batch() as batch:
+            batch.set_bias_current(current_in_uA=[12.0,8.0,3.0,8.0])
+            batch.set_trigger_level(trigger_level_mV=[23.0,24.0,25.0,26.0])
+            batch.set_measurement_periode(10)
+    On leaving the block the commands are sent and, with confirm=True, the
+    driver broadcasts of all labels are awaited once. batch.confirmed then
+    holds the confirmed value per label.
+    """
+    def __init__(self, websq, confirm=True, timeout=None):
+        self.websq = websq
+        self.confirm = confirm
+        self.timeout = timeout
+        self.msgs = []
+        self.confirmed = dict()
+
+    def _set(self, msg, confirm, timeout=None):
+        self.msgs.append(msg)
+
+    #Same commands as WebSQControl, queued by _set instead of sent
+    set_measurement_periode = WebSQControl.set_measurement_periode
+    set_bias_current = WebSQControl.set_bias_current
+    set_trigger_level = WebSQControl.set_trigger_level
+    enable_detectors = WebSQControl.enable_detectors
+
+    def commit(self):
+        """Send all queued commands, return the confirmed value per label (with confirm)."""
+        msgs, self.msgs = self.msgs, []
+        if not msgs:
+            return self.confirmed
+        if not self.confirm:
+            self.websq.talk.send("".join(json.dumps(msg) for msg in msgs))
+            return self.confirmed
+        #The last command per label decides the value to confirm
+        expected = collections.OrderedDict()
+        for msg in msgs:
+            expected[msg["label"]] = msg["value"]
+        labels = list(expected.keys())
+        props = self.websq.talk.set_and_confirm_many(msgs, labels, timeout=self.timeout,
+                                                      values=list(expected.values()))
+        self.confirmed = dict((label, props[label]["value"]) for label in labels)
+        return self.confirmed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
 
 if __name__ == "__main__":
     websq = WebSQControl(TCP_IP_ADR="localhost")
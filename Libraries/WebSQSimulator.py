@@ -0,0 +1,336 @@
+"""
+Local simulator of the Single Quantum WebSQ driver.
+
+Speaks both protocols used by WebSQControl:
+    - control port: JSON messages, answers terminated by \\x17, labelProps
+      dump and label broadcasts after every command
+    - counts port: one comma separated frame (timestamp in ms, counts per
+      detector) per measurement period
+
+Counts are Poisson distributed. The rate of every detector depends on its
+bias current, the wavelength and the incident photon flux, see DetectorModel.
+
+Run stand-alone with
+    python WebSQSimulator.py --detectors 32 --period 1
+and connect with WebSQControl(TCP_IP_ADR="localhost").
+"""
+
+import socket
+import json
+import threading
+import time
+import numpy as np
+
+class DetectorModel(object):
+    """
+    Simple physical model of an array of SNSPDs.
+
+    - internal efficiency: sigmoid in the bias current, the knee moves to
+      higher currents for longer wavelengths (less energy per photon)
+    - absorption: gaussian cavity resonance around center_wavelength
+    - dark counts: rise exponentially towards the switching current
+    - above the switching current the detector latches and counts nothing
+
+    INPUT:
+        number_of_detectors (INT)
+        switching_current = mean switching current in uA (FLOAT)
+        spread = relative spread of the switching current between detectors (FLOAT)
+    """
+    def __init__(self, number_of_detectors = 8, switching_current = 30., spread = 0.05,
+                 max_efficiency = 0.85, center_wavelength = 1550., bandwidth = 150.,
+                 dark_counts = 1000., seed = None):
+        rng = np.random.default_rng(seed)
+        self.number_of_detectors = number_of_detectors
+        self.switching_current = switching_current*(1 + spread*rng.standard_normal(number_of_detectors))
+        self.max_efficiency = max_efficiency
+        self.center_wavelength = center_wavelength
+        self.bandwidth = bandwidth
+        #Dark count rate (Hz) at the switching current, decays with 1/e per dark_width uA
+        self.dark_counts = dark_counts
+        self.dark_width = 0.05*switching_current
+        #Knee of the efficiency curve relative to the switching current and its width at 1550 nm
+        self.knee = 0.7
+        self.knee_width = 0.04*switching_current
+
+    def efficiency(self, bias_current, wavelength):
+        """System detection efficiency of every detector (0..1)."""
+        bias_current = np.asarray(bias_current, dtype=float)
+        knee = self.knee*self.switching_current*np.sqrt(wavelength/1550.)
+        internal = 1/(1 + np.exp(-(bias_current - knee)/self.knee_width))
+        absorption = np.exp(-0.5*((wavelength - self.center_wavelength)/self.bandwidth)**2)
+        eff = self.max_efficiency*absorption*internal
+        return np.where(bias_current < self.switching_current, eff, 0.)
+
+    def dark_count_rate(self, bias_current):
+        """Dark count rate (Hz) of every detector."""
+        bias_current = np.asarray(bias_current, dtype=float)
+        dark = self.dark_counts*np.exp((bias_current - self.switching_current)/self.dark_width)
+        return np.where(bias_current < self.switching_current, dark, 0.)
+
+    def bias_for_dark_counts(self, dark_counts):
+        """Bias current (uA) at which every detector shows the given dark count rate."""
+        dark_counts = np.maximum(np.asarray(dark_counts, dtype=float), 1e-9)
+        bias = self.switching_current + self.dark_width*np.log(dark_counts/self.dark_counts)
+        return np.minimum(bias, 0.999*self.switching_current)
+
+    def rate(self, bias_current, wavelength, photon_flux):
+        """Count rate (Hz) of every detector for a photon flux (photons/s) per detector."""
+        return self.efficiency(bias_current, wavelength)*photon_flux + self.dark_count_rate(bias_current)
+
+class WebSQSimulator(object):
+    """
+    TCP server emulating one WebSQ driver.
+
+    INPUT:
+        number_of_detectors (INT)
+        period_ms = initial measurement period in ms
+        jitter_ms = standard deviation of the delivery time of every frame in ms
+        wavelength = wavelength of the incident light in nm
+        photon_flux = incident photons/s per detector, a scalar or one value per detector
+        autoiv_time = duration of the automatic bias calibration in s
+    """
+    def __init__(self, host = 'localhost', control_port = 12000, counts_port = 12345,
+                 number_of_detectors = 8, period_ms = 100, jitter_ms = 0., wavelength = 1550.,
+                 photon_flux = 1e5, autoiv_time = 2., seed = None):
+        self.host = host
+        self.control_port = control_port
+        self.counts_port = counts_port
+        self.jitter_ms = jitter_ms
+        self.wavelength = wavelength
+        self.photon_flux = photon_flux
+        self.autoiv_time = autoiv_time
+        self.model = DetectorModel(number_of_detectors, seed=seed)
+        self.rng = np.random.default_rng(seed)
+
+        n = number_of_detectors
+        self.labels = {
+            "NumberOfDetectors":     dict(value=n),
+            "InptMeasurementPeriod": dict(value=period_ms, unit="ms", min=1, max=60000),
+            "BiasCurrent":           dict(value=[0.]*n, unit="uA", min=0, max=100),
+            "TriggerLevel":          dict(value=[20.]*n, unit="mV", min=0, max=1000),
+            "DetectorEnable":        dict(value=False),
+            "BiasVoltage":           dict(value=[0.]*n, unit="mV"),
+            "DarkCountsAutoIV":      dict(value=[100.]*n, unit="Hz"),
+            "StartAutoIV":           dict(value=False),
+        }
+        self.lock = threading.Lock()
+        self.control_clients = []
+        self.counts_clients = []
+        self.shutdown = False
+        self.threads = []
+
+    def start(self):
+        """Open both ports and start serving. Port 0 picks a free port."""
+        self.control_server = self._listen(self.control_port)
+        self.counts_server = self._listen(self.counts_port)
+        self.control_port = self.control_server.getsockname()[1]
+        self.counts_port = self.counts_server.getsockname()[1]
+        for target in (self._accept_control, self._accept_counts, self._emit_counts):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.shutdown = True
+        for s in [self.control_server, self.counts_server] + self.control_clients + self.counts_clients:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            s.close()
+        for t in self.threads:
+            t.join(1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def set_optical_power(self, power_W):
+        """Set the photon flux per detector from an optical power in W at the current wavelength."""
+        h = 6.62607015*10**(-34)
+        c = 299792458
+        self.photon_flux = np.asarray(power_W)/(h*c/(self.wavelength*10**-9))
+
+    def _listen(self, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, port))
+        s.listen(16)
+        return s
+
+    def _accept(self, server, clients, handler):
+        while not self.shutdown:
+            try:
+                conn, _ = server.accept()
+            except socket.error:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                clients.append(conn)
+            if handler is not None:
+                t = threading.Thread(target=handler, args=(conn,))
+                t.daemon = True
+                t.start()
+
+    def _accept_control(self):
+        self._accept(self.control_server, self.control_clients, self._serve_control)
+
+    def _accept_counts(self):
+        self._accept(self.counts_server, self.counts_clients, None)
+
+    def _drop(self, conn, clients):
+        with self.lock:
+            if conn in clients:
+                clients.remove(conn)
+        conn.close()
+
+    def _send(self, conn, messages):
+        data = b"".join(bytes(json.dumps(m), "utf-8") + b"\x17" for m in messages)
+        conn.sendall(data)
+
+    def _broadcast(self, label):
+        with self.lock:
+            msg = dict(label=label, value=self.labels[label]["value"])
+            for conn in list(self.control_clients):
+                try:
+                    self._send(conn, [msg])
+                except socket.error:
+                    pass
+
+    def _serve_control(self, conn):
+        decoder = json.JSONDecoder()
+        buf = ""
+        while not self.shutdown:
+            try:
+                r = conn.recv(65536)
+            except socket.error:
+                r = b""
+            if not r:
+                self._drop(conn, self.control_clients)
+                return
+            buf += str(r, "utf-8", "replace")
+            while buf:
+                buf = buf.lstrip()
+                try:
+                    msg, end = decoder.raw_decode(buf)
+                except ValueError:
+                    #Incomplete message, wait for the rest
+                    break
+                buf = buf[end:]
+                try:
+                    self._handle(conn, msg)
+                except socket.error:
+                    pass
+
+    def _handle(self, conn, msg):
+        if msg.get("request") == "labelProps":
+            with self.lock:
+                self._send(conn, [dict(label=k, value=dict(v)) for k, v in self.labels.items()])
+        elif "request" in msg:
+            if msg["request"] in self.labels:
+                self._broadcast(msg["request"])
+        elif "command" in msg:
+            self._command(conn, msg["command"], msg.get("value"))
+
+    def _command(self, conn, command, value):
+        n = self.model.number_of_detectors
+        if command == "SetAllBiasCurrents":
+            self._set("BiasCurrent", [float(v) for v in value])
+            self._set("BiasVoltage", [float(v)*10. for v in value])
+        elif command == "SetAllTriggerLevels":
+            self._set("TriggerLevel", [float(v) for v in value])
+        elif command == "SetMeasurementPeriod":
+            self._set("InptMeasurementPeriod", max(1, int(value)))
+        elif command == "DetectorEnable":
+            self._set("DetectorEnable", bool(value))
+        elif command == "DarkCountsAutoIV":
+            self._set("DarkCountsAutoIV", [float(v) for v in value])
+        elif command == "AutoCaliBiasCurrents":
+            t = threading.Thread(target=self._auto_iv)
+            t.daemon = True
+            t.start()
+        else:
+            with self.lock:
+                self._send(conn, [dict(label="Error", value="Unknown command " + str(command))])
+            return
+        if command in ("SetAllBiasCurrents", "SetAllTriggerLevels", "DarkCountsAutoIV") and len(value) != n:
+            with self.lock:
+                self._send(conn, [dict(label="Error", value=command + " expects %d values" % n)])
+
+    def _set(self, label, value):
+        with self.lock:
+            self.labels[label]["value"] = value
+        self._broadcast(label)
+
+    def _auto_iv(self):
+        self._set("StartAutoIV", True)
+        time.sleep(self.autoiv_time)
+        bias = self.model.bias_for_dark_counts(self.labels["DarkCountsAutoIV"]["value"])
+        bias = [round(float(b), 2) for b in bias]
+        self._set("BiasCurrent", bias)
+        self._set("BiasVoltage", [b*10. for b in bias])
+        self._set("StartAutoIV", False)
+
+    def frame_rates(self):
+        """Current count rate (Hz) of every detector."""
+        with self.lock:
+            if not self.labels["DetectorEnable"]["value"]:
+                return np.zeros(self.model.number_of_detectors)
+            bias = self.labels["BiasCurrent"]["value"]
+        return self.model.rate(bias, self.wavelength, self.photon_flux)
+
+    def _emit_counts(self):
+        next_t = time.time()
+        while not self.shutdown:
+            period = self.labels["InptMeasurementPeriod"]["value"]*1e-3
+            next_t += period
+            delay = next_t - time.time()
+            if self.jitter_ms:
+                delay += abs(self.rng.normal(0, self.jitter_ms*1e-3))
+            if delay > 0:
+                time.sleep(delay)
+            #Send every frame that is due, several at once if the sender fell behind
+            now = time.time()
+            k = 1 + max(0, int((now - next_t)/period))
+            stamps = next_t + period*np.arange(k)
+            next_t = stamps[-1]
+            counts = self.rng.poisson(self.frame_rates()*period, size=(k, self.model.number_of_detectors))
+            data = "".join("%.3f," % (t*1e3) + ",".join(map(str, row)) + "\n"
+                           for t, row in zip(stamps.tolist(), counts.tolist()))
+            data = bytes(data, "utf-8")
+            with self.lock:
+                clients = list(self.counts_clients)
+            for conn in clients:
+                try:
+                    conn.sendall(data)
+                except socket.error:
+                    self._drop(conn, self.counts_clients)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulated WebSQ driver")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--control-port", type=int, default=12000)
+    parser.add_argument("--counts-port", type=int, default=12345)
+    parser.add_argument("--detectors", type=int, default=8)
+    parser.add_argument("--period", type=float, default=100, help="measurement period in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="delivery jitter in ms")
+    parser.add_argument("--wavelength", type=float, default=1550, help="nm")
+    parser.add_argument("--flux", type=float, default=1e5, help="photons/s per detector")
+    args = parser.parse_args()
+
+    sim = WebSQSimulator(host=args.host, control_port=args.control_port, counts_port=args.counts_port,
+                         number_of_detectors=args.detectors, period_ms=args.period, jitter_ms=args.jitter,
+                         wavelength=args.wavelength, photon_flux=args.flux)
+    sim.start()
+    print("Simulating %d detectors on %s, control port %d, counts port %d"
+          % (args.detectors, args.host, sim.control_port, sim.counts_port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,113 @@
+"""
+Columnar container for a block of count measurements.
+
+A CountBlock keeps the frames of one acquisition as NumPy arrays: the driver
+timestamps and a (frames, channels) matrix of counts, together with the
+channel names and the settings of the acquisition. A pandas DataFrame is only
+built when asked for with to_frame().
+
+    block = detected_counts(...)
+    block.mean()                # count rate per detector in counts/s
+    block["Channel 7"]          # counts of one detector, one value per frame
+    block.to_frame()            # DataFrame with "Timestamp" and "Channel 1".."Channel N"
+"""
+
+import numpy as np
+
+class CountBlock(object):
+    """
+    INPUT:
+        timestamps = array of the driver timestamps, one per frame
+        counts = array (frames, channels) with the counts per frame
+        channels = LIST of channel names, default "Channel 1".."Channel N"
+        metadata = DICT with the settings of the acquisition, measurement_periode_ms
+                   is used to convert counts to count rates
+        host_times = optional array with the time.time() each frame was received
+    """
+    def __init__(self, timestamps, counts, channels = None, metadata = None, host_times = None):
+        self.timestamps = np.asarray(timestamps)
+        self.counts = np.asarray(counts)
+        if self.counts.ndim != 2 or len(self.counts) != len(self.timestamps):
+            raise ValueError("counts must be (frames, channels) with one row per timestamp")
+        if channels is None:
+            channels = ["Channel " + str(i + 1) for i in range(self.counts.shape[1])]
+        if len(channels) != self.counts.shape[1]:
+            raise ValueError("%d channel names for %d channels" % (len(channels), self.counts.shape[1]))
+        self.channels = list(channels)
+        self.metadata = dict(metadata or {})
+        self.host_times = None if host_times is None else np.asarray(host_times)
+        self._frame = None
+
+    @classmethod
+    def from_frames(cls, frames, channels = None, metadata = None, host_times = None):
+        """Build a block from frames as returned by aquire_cnts, timestamp in the first column."""
+        frames = np.asarray(frames)
+        return cls(frames[:, 0], frames[:, 1:], channels=channels, metadata=metadata, host_times=host_times)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, channel):
+        if channel == "Timestamp":
+            return self.timestamps
+        if channel == "Host time" and self.host_times is not None:
+            return self.host_times
+        return self.counts[:, self.channels.index(channel)]
+
+    def __repr__(self):
+        return "CountBlock(%d frames, %d channels)" % self.counts.shape
+
+    @property
+    def period(self):
+        """Measurement period in s, None if unknown."""
+        period = self.metadata.get("measurement_periode_ms")
+        return None if period is None else period*10**(-3)
+
+    @property
+    def rates(self):
+        """Count rates (frames, channels) in counts/s."""
+        if self.period is None:
+            raise ValueError("Measurement period unknown, set metadata measurement_periode_ms")
+        return self.counts/self.period
+
+    def mean(self):
+        """Mean count rate per channel in counts/s, mean counts per frame if the period is unknown."""
+        if self.period is None:
+            return self.counts.mean(axis=0)
+        return self.rates.mean(axis=0)
+
+    def std(self):
+        """Standard deviation per channel, in the same unit as mean()."""
+        if self.period is None:
+            return self.counts.std(axis=0, ddof=1)
+        return self.rates.std(axis=0, ddof=1)
+
+    def select(self, rows):
+        """Return a new block with only the given frames (boolean mask or indices)."""
+        host_times = None if self.host_times is None else self.host_times[rows]
+        return CountBlock(self.timestamps[rows], self.counts[rows], self.channels, self.metadata, host_times)
+
+    def to_frame(self, rates = True):
+        """
+        DataFrame with "Timestamp", "Host time" if known, and one column per channel,
+        frames numbered from 1.
+        With rates the counts are converted to counts/s. The frame is built once.
+        """
+        import pandas as pd
+        if self._frame is None or self._frame[0] != rates:
+            values = self.rates if rates else self.counts
+            df = pd.DataFrame(values, columns=self.channels, index=np.arange(1, len(self) + 1))
+            if self.host_times is not None:
+                df.insert(0, "Host time", self.host_times)
+            df.insert(0, "Timestamp", self.timestamps)
+            self._frame = (rates, df)
+        return self._frame[1]
+
+def mean_table(blocks, key):
+    """
+    DataFrame of the mean count rates of several blocks, one column per block
+    named by its metadata[key] (e.g. "wavelength"), one row per channel.
+    """
+    import pandas as pd
+    return pd.DataFrame(dict((block.metadata[key], block.mean()) for block in blocks),
+                        index=blocks[0].channels if blocks else None)
@@ -0,0 +1,118 @@
+"""
+Reject noisy frames from blocks of count measurements.
+
+A CountFilter is a list of rules, each configured for some channels. All
+rules are evaluated on the whole (frames, channels) matrix at once, a frame
+is rejected if any rule rejects it, and the number of frames each rule
+rejected is reported.
+
+    noise = CountFilter().threshold("Channel 7", min=20000).latch("Channel 7", min_run=3)
+    block, rejected = noise.apply(block)
+    rejected        # {"threshold Channel 7": 2, "latch": 0, "total": 2}
+
+Values are count rates in counts/s if the measurement period of the block is
+known, counts per frame otherwise.
+"""
+
+import numpy as np
+
+class CountFilter(object):
+    def __init__(self):
+        self.rules = []
+
+    def _add(self, name, default, fn, channels):
+        if channels is not None and isinstance(channels, str):
+            channels = [channels]
+        self.rules.append((name or default, fn, channels))
+        return self
+
+    def threshold(self, channel, min = None, max = None, name = None):
+        """Reject frames in which channel (name or LIST of names) is below min or above max."""
+        def rule(values, scale):
+            rejected = np.zeros(values.shape, dtype=bool)
+            if min is not None:
+                rejected |= values < min
+            if max is not None:
+                rejected |= values > max
+            return rejected
+        default = "threshold " + (channel if isinstance(channel, str) else ", ".join(channel))
+        return self._add(name, default, rule, channel)
+
+    def outliers(self, channels = None, method = "mad", n = 5., name = None):
+        """
+        Reject frames deviating more than n standard deviations from the block in any
+        of the channels (default all). With method "mad" the deviation is estimated
+        from the median absolute deviation, so the outliers themselves do not hide
+        in a widened spread; "sigma" uses mean and standard deviation.
+        The deviation is at least the Poisson noise of one frame, sqrt(counts) but
+        at least 1 count, so dark and low count channels (MAD 0) still lose their spikes.
+        """
+        if method not in ("mad", "sigma"):
+            raise ValueError('method must be "mad" or "sigma"')
+        def rule(values, scale):
+            if method == "mad":
+                center = np.median(values, axis=0)
+                spread = 1.4826*np.median(np.abs(values - center), axis=0)
+            else:
+                center = values.mean(axis=0)
+                spread = values.std(axis=0, ddof=1) if len(values) > 1 else np.zeros(values.shape[1])
+            #scale converts counts per frame to the unit of values
+            poisson = np.sqrt(np.maximum(np.abs(center)/scale, 1))*scale
+            return np.abs(values - center) > n*np.maximum(spread, poisson)
+        return self._add(name, method, rule, channels)
+
+    def latch(self, channels, min_run = 1, name = None):
+        """
+        Reject frames in which a channel (name or LIST of names) reads zero counts for
+        at least min_run frames in a row, as happens when a detector latches.
+        Only give the detectors in use, unused ones read zero all the time.
+        """
+        def rule(values, scale):
+            zero = (values == 0).astype(int)
+            if min_run <= 1:
+                return zero.astype(bool)
+            # runs of min_run zeros start where the sum over the next min_run frames is min_run
+            csum = np.concatenate((np.zeros((1, zero.shape[1]), dtype=int), np.cumsum(zero, axis=0)))
+            starts = (csum[min_run:] - csum[:-min_run]) == min_run
+            # mark every frame of these runs
+            cstart = np.concatenate((np.zeros((1, zero.shape[1]), dtype=int), np.cumsum(starts, axis=0)))
+            cstart = np.concatenate((cstart, np.repeat(cstart[-1:], min_run - 1, axis=0)))
+            lo = np.maximum(np.arange(len(zero)) - min_run + 1, 0)
+            return (cstart[np.arange(len(zero)) + 1] - cstart[lo]) > 0
+        return self._add(name, "latch", rule, channels)
+
+    def masks(self, values, channels, scale = 1.):
+        """
+        Evaluate every rule on values (frames, channels) with column names channels,
+        scale = values per count (1/period for count rates).
+        Return (dict): rule name -> boolean array, True for the rejected frames
+        """
+        result = dict()
+        for name, fn, rule_channels in self.rules:
+            if rule_channels is None:
+                columns = slice(None)
+            else:
+                columns = [channels.index(c) for c in rule_channels]
+            rejected = fn(values[:, columns], scale).any(axis=1)
+            if name in result:
+                rejected |= result[name]
+            result[name] = rejected
+        return result
+
+    def apply(self, block):
+        """
+        Filter a CountBlock.
+        Return (CountBlock, dict): the kept frames, and the number of frames rejected
+            per rule plus "total" (a frame can be rejected by several rules)
+        """
+        if block.period is None:
+            masks = self.masks(block.counts, block.channels)
+        else:
+            masks = self.masks(block.rates, block.channels, 1/block.period)
+        rejected = np.zeros(len(block), dtype=bool)
+        report = dict()
+        for name, mask in masks.items():
+            rejected |= mask
+            report[name] = int(mask.sum())
+        report["total"] = int(rejected.sum())
+        return block.select(~rejected), report
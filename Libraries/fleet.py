@@ -0,0 +1,136 @@
+"""
+Operate several SNSPD drivers as one.
+
+Every system is a WebSQControl, commands and acquisitions are issued to all
+of them concurrently, so a step takes as long as the slowest system instead
+of the sum of all of them.
+
+    with SNSPDFleet({"cryo1": "192.168.1.163", "cryo2": "192.168.1.164"}) as fleet:
+        fleet.configure(bias=25, period=100)
+        cnts = fleet.aquire_cnts(10)
+        cnts["cryo2"]["Channel 3"]
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from WebSQControl import WebSQControl, HostTime
+
+class SNSPDFleet(object):
+    """
+    INPUT:
+        systems = DICT name -> tcp_ip_address, or name -> (tcp_ip_address, control_port, counts_port)
+        CNTS_BUFFER = frames kept per system, see WebSQControl
+    """
+    def __init__(self, systems, CNTS_BUFFER = 100):
+        self.systems = dict()
+        for name, address in systems.items():
+            if isinstance(address, str):
+                address = (address, 12000, 12345)
+            ip, control_port, counts_port = address
+            self.systems[name] = WebSQControl(TCP_IP_ADR=ip, CONTROL_PORT=control_port,
+                                              COUNTS_PORT=counts_port, CNTS_BUFFER=CNTS_BUFFER)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.systems)))
+
+    def _parallel(self, fn, *args):
+        """Run fn(name, websq, *args) for all systems concurrently, return DICT name -> result."""
+        futures = dict((name, self.executor.submit(fn, name, websq, *args))
+                       for name, websq in self.systems.items())
+        return dict((name, future.result()) for name, future in futures.items())
+
+    def connect(self):
+        self._parallel(lambda name, websq: websq.connect())
+        return self
+
+    def close(self):
+        def close(name, websq):
+            if hasattr(websq, "talk"):
+                websq.close()
+        self._parallel(close)
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def number_of_detectors(self):
+        return dict((name, websq.NUMBER_OF_DETECTORS) for name, websq in self.systems.items())
+
+    def _per_system(self, value, name, websq, per_detector):
+        #value for all systems, or DICT name -> value. Scalars are expanded to all detectors.
+        if isinstance(value, dict):
+            value = value[name]
+        if per_detector and np.isscalar(value):
+            value = [value]*websq.NUMBER_OF_DETECTORS
+        return value
+
+    def configure(self, bias = None, trigger = None, period = None, enable = None, confirm = True, timeout = None):
+        """
+        Apply settings to all systems in parallel, one batched write per system.
+
+        INPUT:
+            bias = bias current in uA: scalar, LIST per detector, or DICT name -> either
+            trigger = trigger level in mV, same forms as bias
+            period = measurement period in ms, scalar or DICT name -> scalar
+            enable = enable the detectors (BOOL)
+            confirm = wait until every driver reports the new values
+        OUTPUT:
+            DICT name -> confirmed values per label
+        """
+        def apply(name, websq):
+            with websq.batch(confirm=confirm, timeout=timeout) as batch:
+                if bias is not None:
+                    batch.set_bias_current(self._per_system(bias, name, websq, True))
+                if trigger is not None:
+                    batch.set_trigger_level(self._per_system(trigger, name, websq, True))
+                if period is not None:
+                    batch.set_measurement_periode(self._per_system(period, name, websq, False))
+                if enable is not None:
+                    batch.enable_detectors(enable)
+            return batch.confirmed
+        return self._parallel(apply)
+
+    def set_bias_current(self, current_in_uA, confirm = True):
+        return self.configure(bias=current_in_uA, confirm=confirm)
+
+    def set_measurement_periode(self, t_in_ms, confirm = True):
+        return self.configure(period=t_in_ms, confirm=confirm)
+
+    def auto_calibrate(self, dark_counts, timeout = None):
+        """
+        Run the automatic bias calibration on all systems at the same time.
+        Make sure that no light reaches the detectors during this procedure.
+
+        INPUT:
+            dark_counts = dark counts in Hz: scalar, LIST per detector, or DICT name -> either
+            timeout = maximal calibration time in s
+        OUTPUT:
+            DICT name -> calibrated bias currents in uA
+        """
+        futures = dict((name, websq.auto_calibrate(self._per_system(dark_counts, name, websq, True), timeout=timeout))
+                       for name, websq in self.systems.items())
+        return dict((name, future.result()) for name, future in futures.items())
+
+    def aquire_cnts(self, n, timeout = None):
+        """
+        Aquire n count measurements on all systems, starting at the same moment.
+
+        Only frames which started after the call are used, so the blocks of all
+        systems cover the same time window.
+
+        OUTPUT:
+            DICT name -> DICT with "Timestamp" (driver time), "Host time" (time.time()
+            of reception) and "Channel 1".."Channel N", each an array of n values
+        """
+        t0 = HostTime(time.time())
+        def aquire(name, websq):
+            frames, host_times = websq.aquire_cnts(n, timeout=timeout, after=t0, host_times=True)
+            block = {"Timestamp": frames[:, 0], "Host time": host_times}
+            for i in range(1, frames.shape[1]):
+                block["Channel " + str(i)] = frames[:, i]
+            return block
+        return self._parallel(aquire)
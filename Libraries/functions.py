@@ -1,8 +1,46 @@
-from WebSQControl import WebSQControl
+from WebSQControl import WebSQControl, HostTime
+from countblock import CountBlock, mean_table
+from writer import ResultWriter
+from filters import CountFilter
+from settling import SettlingDetector, wait_settled
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import warnings
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
+def snspd_session(tcp_ip_address, control_port, counts_port):
+    """
+    Open a connection to the SNSPD driver which can be reused for a whole experiment.
+    Pass it as websq to detected_counts, count_rate and measurements to avoid
+    reconnecting for every measurement point. Close it with websq.close() or use it
+    as a context manager:
+
+        with snspd_session(tcp_ip_address, control_port, counts_port) as websq:
+            count_rate(tcp_ip_address, control_port, counts_port, list_Ib, N, number_of_detectors, websq=websq)
+
+    OUTPUT:
+        websq = connected WebSQControl
+    """
+    websq = WebSQControl(TCP_IP_ADR = tcp_ip_address, CONTROL_PORT = control_port, COUNTS_PORT = counts_port)
+    websq.connect()
+    return websq
+
+@contextmanager
+def _session(websq, tcp_ip_address, control_port, counts_port):
+    # use the given session, or open one only for the duration of the call
+    if websq is not None:
+        yield websq
+        return
+    websq = snspd_session(tcp_ip_address, control_port, counts_port)
+    try:
+        yield websq
+    finally:
+        websq.close()
+
 def current_setter(number_of_detectors, Irange):
     """
     This function sets the current for all detectors in the SNSPD system in one time
@@ -69,7 +107,8 @@ def start_snspd(N, tcp_ip_address, control_port, counts_port):
     print("============================\n")
     return ms_time, bias_current, trigger, number_of_detectors
 
-def detected_counts(tcp_ip_address, control_port, counts_port, N, number_of_detectors, Ib,wav):
+def detected_counts(tcp_ip_address, control_port, counts_port, N, number_of_detectors, Ib,wav, websq=None, writer=None,
+                    count_filter=None):
     """
 
     Parameters
@@ -80,55 +119,49 @@ def detected_counts(tcp_ip_address, control_port, counts_port, N, number_of_dete
     N = number of measurements to be taken (INT)
     number_of_detectors
     Ib = bias current (LIST), for every detector a value
-    wav = INT, used for naming the xlsx file
+    wav = INT, used for naming the counts file
+    websq = open session from snspd_session(), if None a connection is opened for this call only
+    writer = ResultWriter saving the counts in the background, default ResultWriter.instance()
+    count_filter = CountFilter rejecting noisy frames, e.g. CountFilter().threshold("Channel 7", min=20000)
+                   for the detector in use. None keeps all frames
 
     Returns
     -------
-    A DataFrame containing all counts, An DataFrame containing the averages per detector.
+    A CountBlock containing all (kept) counts, block.mean() gives the average count rate per detector
+    and block.to_frame() a DataFrame. block.metadata["rejected"] holds the frames rejected per rule.
 
     """
-    websq = WebSQControl(TCP_IP_ADR = tcp_ip_address, CONTROL_PORT = control_port, COUNTS_PORT = counts_port)
-    websq.connect()
-    
+    with _session(websq, tcp_ip_address, control_port, counts_port) as websq:
+        return _detected_counts(websq, N, number_of_detectors, Ib, wav, writer, count_filter)
+
+def _detected_counts(websq, N, number_of_detectors, Ib, wav, writer=None, count_filter=None):
     # start by setting bias current
-    websq.set_bias_current(current_in_uA     = Ib)
+    websq.set_bias_current(current_in_uA     = Ib, confirm=True)
+    bias_set = HostTime(time.time())
     
     ms_time = websq.get_measurement_periode()
     
     #Aquire N counts measurements
-    #Returns an array filled with N numpy arrays each
+    #Returns an array with one row per measurement,
     #containing as first element a time stamp and then the detector counts in ascending order.
-    counts = websq.aquire_cnts(N)
-    for i in range(1,len(counts)):
-        counts[i]=counts[i]*1/(ms_time*10**(-3))
-        
-    # create dataframe out of the measurements
-    df = pd.DataFrame()
-    for i in range(len(counts)):
-        df = df.append(pd.DataFrame(counts[i]).T)
+    # only measurements taken completely at the new bias current
+    counts, host_times = websq.aquire_cnts(N, after=bias_set, host_times=True)
+    block = CountBlock.from_frames(counts, metadata=dict(bias_current=Ib, wavelength=wav,
+                                                         measurement_periode_ms=ms_time, started=bias_set),
+                                   host_times=host_times)
     
-    # some styling to the indices to make it easier to extract data
-    headers = ["Channel "+str(1+i) for i in range(number_of_detectors)]
-    meas = [i for i in range(1,N+1)]
-    headers.insert(0, "Timestamp")
-
-    df.set_axis(headers, axis=1, inplace=True)
-    df.set_axis(meas, axis = 0, inplace=True)
-    
-    # remove noise in the used detector
-    # add more of such lines if more ports are used
-    df = df[df["Channel 7"] > 20000] 
+    # remove noise, e.g. in the used detector
+    if count_filter is not None:
+        block, rejected = count_filter.apply(block)
+        block.metadata["rejected"] = rejected
     
     # used if this function is used in a loop for different wavelengths
-    df.to_excel("counts"+str(wav)+".xlsx") 
-    
-    # calculate average counts for each column (detector) in the dataframe
-    avgs_detect = df.mean(axis=0)  
-    websq.close()
+    (writer or ResultWriter.instance()).write(block, "counts"+str(wav))
     
-    return avgs_detect, df
+    return block
 
-def count_rate(tcp_ip_address, control_port, counts_port, list_Ib, N, number_of_detectors):
+def count_rate(tcp_ip_address, control_port, counts_port, list_Ib, N, number_of_detectors, websq=None, writer=None,
+               count_filter=None):
     """
     This function measures the photon count rate for a range of current values values
     per detector in the system at a set wavelength (set manually)
@@ -138,24 +171,190 @@ def count_rate(tcp_ip_address, control_port, counts_port, list_Ib, N, number_of_
     list_Ib: a nested list containing different bias currents
     List inside the list contains currents specified for each detector
     xIb: the range of values for Ib used for the plot
+    websq: open session from snspd_session(), if None one connection is used for the whole sweep
+    writer: ResultWriter for the counts files, default ResultWriter.instance()
+    count_filter: CountFilter applied to every point, see detected_counts
 
     Returns
     -------
-    avgscounts: a list of avg photon counts.
+    blocks: a list of CountBlocks, one per bias current, see detected_counts
 
     """
 
-    # create an empty list to store the photon counts
-    avgscounts=[]
-    for i in list_Ib:
-        avgs = detected_counts(tcp_ip_address, control_port, counts_port, N, number_of_detectors, i,0)[0].tolist()
+    blocks=[]
+    with _session(websq, tcp_ip_address, control_port, counts_port) as websq:
+        for i in list_Ib:
+            blocks.append(_detected_counts(websq, N, number_of_detectors, i,0, writer, count_filter))
+    return blocks
+    
+def bias_sweep(websq, currents, frames_per_point, settle=0, timeout=None):
+    """
+    Measure the counts for a range of bias currents on one open connection.
+    
+    For every point the bias current is set and confirmed by the driver. All frames
+    which were (partly) integrated before the confirmation, plus an optional settle
+    time, are discarded, then frames_per_point frames are taken. No file is written.
+    
+    INPUT:
+        websq = open session from snspd_session()
+        currents = LIST of bias currents (microA), every entry a value for all
+                   detectors or a LIST with a value per detector (see current_setter)
+        frames_per_point = number of frames per bias current (INT)
+        settle = extra waiting time after the bias change in s
+        timeout = maximal waiting time per point in s
         
-    # since the output of the detected_counts() is a list (containing timestamp), 
-    # the timestamp is removed and all other values are appended to a list  
-        for j in avgs[1:]:
-            avgscounts.append(j)
-    return avgscounts
+    OUTPUT:
+        counts = np.array (points, frames, detectors) with the counts of every frame
+        means = np.array (points, detectors), mean count rate per point in counts/s
+    """
+    number_of_detectors = websq.NUMBER_OF_DETECTORS
+    period = websq.get_measurement_periode()*10**(-3)
+    
+    counts = np.empty((len(currents), frames_per_point, number_of_detectors))
+    for i, Ib in enumerate(currents):
+        if np.isscalar(Ib):
+            Ib = [Ib]*number_of_detectors
+        websq.set_bias_current([float(I) for I in Ib], confirm=True)
+        frames = websq.aquire_cnts(frames_per_point, timeout=timeout, after=HostTime(time.time()), settle=settle)
+        counts[i] = frames[:, 1:]
+        
+    means = counts.mean(axis=1)/period
+    return counts, means
+
+def adaptive_bias_sweep(websq, Imin, Imax, frames_per_point, n_start=5, resolution=0.5, tolerance=0.02,
+                        max_points=40, detectors=None, settle=0, timeout=None):
+    """
+    Bias sweep which puts its points where the count rate curve bends.
+    
+    Starts with n_start equidistant currents and then repeatedly measures the middle
+    of every interval next to a point where the curve deviates from a straight line
+    (curvature) by more than tolerance of its full range and more than twice its
+    statistical uncertainty. Stops when no such interval is wider than resolution
+    or max_points are measured. The flat dark region and plateau therefore get few
+    points, the knee and the switching current many.
     
+    INPUT:
+        websq = open session from snspd_session()
+        Imin, Imax = range of bias currents in microA, the same for all detectors
+        frames_per_point = number of frames per bias current (INT)
+        n_start = number of points of the first, coarse sweep
+        resolution = smallest spacing between points in microA
+        tolerance = curvature, relative to the range of the curve, below which an interval is not refined
+        max_points = maximal number of points
+        detectors = LIST of detector indices (0 based) used to decide, default all
+        settle, timeout = see bias_sweep
+        
+    OUTPUT:
+        currents = np.array of the measured currents, sorted
+        counts = np.array (points, frames, detectors) with the counts of every frame
+        means = np.array (points, detectors), mean count rate per point in counts/s
+    """
+    period = websq.get_measurement_periode()*10**(-3)
+    currents = np.linspace(Imin, Imax, n_start)
+    counts, means = bias_sweep(websq, currents, frames_per_point, settle=settle, timeout=timeout)
+    
+    while len(currents) < max_points:
+        order = np.argsort(currents)
+        currents, counts, means = currents[order], counts[order], means[order]
+        
+        rates = means if detectors is None else means[:, detectors]
+        frames = counts if detectors is None else counts[:, :, detectors]
+        se = frames.std(axis=1, ddof=1)/np.sqrt(frames_per_point)/period
+        span = np.maximum(rates.max(axis=0) - rates.min(axis=0), 1e-12)
+        
+        # deviation of every inner point from the line through its neighbours
+        I0, I1, I2 = currents[:-2, None], currents[1:-1, None], currents[2:, None]
+        w0 = (I2 - I1)/(I2 - I0)
+        w2 = (I1 - I0)/(I2 - I0)
+        curv = np.abs(rates[1:-1] - w0*rates[:-2] - w2*rates[2:])
+        curv_se = np.sqrt(se[1:-1]**2 + (w0*se[:-2])**2 + (w2*se[2:])**2)
+        score = np.max(np.where(curv > 2*curv_se, curv/span, 0), axis=1)
+        
+        # an interval is as interesting as the more curved of its two end points
+        point_score = np.concatenate(([0], score, [0]))
+        interval_score = np.maximum(point_score[:-1], point_score[1:])
+        interval_score[np.diff(currents) < 2*resolution] = 0
+        
+        refine = np.argsort(interval_score)[::-1]
+        refine = refine[interval_score[refine] > tolerance][:max_points - len(currents)]
+        if len(refine) == 0:
+            break
+        
+        new = (currents[refine] + currents[refine + 1])/2
+        new_counts, new_means = bias_sweep(websq, new, frames_per_point, settle=settle, timeout=timeout)
+        currents = np.concatenate((currents, new))
+        counts = np.concatenate((counts, new_counts))
+        means = np.concatenate((means, new_means))
+        
+    order = np.argsort(currents)
+    return currents[order], counts[order], means[order]
+
+def plan_acquisition(websq, target_rel_err, pilot_rates=None, pilot_frames=3, detectors=None,
+                     min_rate=0, min_period=10, max_period=10000, min_frames=2, max_frames=None,
+                     max_time=600, apply=True):
+    """
+    Choose the measurement period and number of frames for a target precision.
+    
+    The relative uncertainty of a Poisson count rate after C counts is 1/sqrt(C), so
+    every channel needs 1/target_rel_err**2 counts. From a quick pilot rate the
+    needed integration time of the dimmest channel follows; the period (whole ms)
+    and number of frames are then chosen to minimise the wall time, which is
+    (frames + 1) periods because the first frame after a change is discarded.
+    Bright points finish within a few periods, dim points get the time they need.
+    
+    INPUT:
+        websq = open session from snspd_session()
+        target_rel_err = wanted relative uncertainty per channel, e.g. 0.01
+        pilot_rates = LIST of count rates (counts/s) per detector, if None they are
+                      measured with pilot_frames frames at the present period
+        detectors = LIST of detector indices (0 based) to plan for, default all. The
+                    dimmest channel decides, so leave out unused detectors: with only
+                    dark counts they would get the integration time of a dark channel
+        min_rate = channels with a pilot rate at or below this (counts/s) are ignored,
+                   e.g. above the dark count rate; if no channel is left (light off,
+                   detectors latched) a ValueError is raised and nothing is changed
+        min_period, max_period = allowed measurement periods in ms
+        min_frames = minimal number of frames, e.g. to be able to reject outliers
+        max_frames = maximal number of frames, default the counts buffer of websq
+        max_time = maximal integration time in s
+        apply = set the chosen period on the driver
+        
+    OUTPUT:
+        plan = DICT with period_ms, frames, time (s, integration), rel_err (expected
+               per detector, None without counts)
+    """
+    if pilot_rates is None:
+        period = websq.get_measurement_periode()*10**(-3)
+        pilot = websq.aquire_cnts(pilot_frames, after=HostTime(time.time()))
+        pilot_rates = pilot[:, 1:].mean(axis=0)/period
+    rates = np.asarray(pilot_rates, dtype=float)
+    used = rates if detectors is None else rates[detectors]
+    used = used[used > min_rate]
+    
+    if len(used) == 0:
+        raise ValueError("No detector to plan for counts more than %g counts/s, pilot rates %s"
+                         % (min_rate, rates.tolist()))
+    needed = min(max_time, 1/(target_rel_err**2*used.min()))
+    
+    if max_frames is None:
+        max_frames = websq.cnts.cnts.capacity
+    
+    # wall time for every possible period, integration at least the needed time
+    periods = np.arange(int(min_period), int(max_period) + 1)
+    frames = np.maximum(min_frames, np.ceil(needed/(periods*10**(-3))))
+    frames = np.minimum(frames, max_frames).astype(int)
+    wall = (frames + 1)*periods
+    # periods too short to reach the needed time within max_frames are not eligible
+    wall[frames*periods*10**(-3) < min(needed, max_frames*max_period*10**(-3))] = np.iinfo(wall.dtype).max
+    best = int(np.argmin(wall))
+    period_ms, n = int(periods[best]), int(frames[best])
+    
+    t = n*period_ms*10**(-3)
+    rel_err = [1/np.sqrt(r*t) if r > 0 else None for r in rates]
+    if apply:
+        websq.set_measurement_periode(period_ms, confirm=True)
+    return dict(period_ms=period_ms, frames=n, time=t, rel_err=rel_err)
+
 def get_power():
     import time
     """
@@ -215,13 +414,14 @@ def get_power():
     return pwr
 
   
-def calibration(waves, number_of_calimeasurements, time_interval):   
+def calibration(waves, number_of_calimeasurements, time_interval, writer=None):   
     """
-    Perform measurements on two powermeters for a range of wavelengths. Store the output in xlsx files
+    Perform measurements on two powermeters for a range of wavelengths. Store the output in files
     INPUT:
         waves = range of wavelengths (LIST)
         number_of_calimeasurements = the number of power measurements to be taken at each wavelength
         time_interval = specify the amount of time to wait between each measurement
+        writer = ResultWriter saving the powers in the background, default ResultWriter.instance()
         
     OUTPUT:
         dflaserP1 = DataFrame containing all powers of powermeter 1, sorted per wavelength
@@ -332,17 +532,18 @@ def calibration(waves, number_of_calimeasurements, time_interval):
     
     dflaserP1.set_axis(headers, axis=1, inplace=True)
     dflaserP1.set_axis(meas, axis = 0, inplace=True)
-    dflaserP1.to_excel('powerfluctP1.xlsx')
+    writer = writer or ResultWriter.instance()
+    writer.write(dflaserP1, 'powerfluctP1')
     
     
     dflaserP2 = pd.DataFrame(laserlistP2).T
     dflaserP2.set_axis(headers, axis=1, inplace=True)
     dflaserP2.set_axis(meas, axis = 0, inplace=True)
-    dflaserP2.to_excel('powerfluctP2.xlsx')
+    writer.write(dflaserP2, 'powerfluctP2')
     
     return dflaserP1, dflaserP2, laserlistP1, laserlistP2
 
-def laser_stability(waves, number_of_calimeasurements, time_interval):
+def laser_stability(waves, number_of_calimeasurements, time_interval, writer=None):
     """
     This function measures the stability of the laser across a range of wavelengths
     taking power measurements every specified time interval
@@ -353,6 +554,8 @@ def laser_stability(waves, number_of_calimeasurements, time_interval):
         LIST CONTAINING LIST OF WAVELENGTH VALUES.
     times : LIST
         DESCRIPTION.
+    writer : ResultWriter
+        SAVES THE POWERS IN THE BACKGROUND, DEFAULT ResultWriter.instance()
 
     Returns
     -------
@@ -418,15 +621,42 @@ def laser_stability(waves, number_of_calimeasurements, time_interval):
     meas = [i for i in range(1,number_of_calimeasurements+1)]
     dflaser.set_axis(headers, axis=1, inplace=True)
     dflaser.set_axis(meas, axis = 0, inplace=True)
-    dflaser.to_excel('powerfluct.xlsx')
+    (writer or ResultWriter.instance()).write(dflaser, 'powerfluct')
     
     return dflaser, laserlist
 
-def measurements(tcp_ip_address, control_port, counts_port, N, number_of_detectors, Ib, waves, db, laserip,laserchannel):
+def _read_power(tlPM):
+    from ctypes import byref, c_double
+    power = c_double()
+    tlPM.measPower(byref(power))
+    print(power.value)
+    return power.value
+
+def _sample_power(tlPM, n=None, interval=0.5, stop=None, min_n=1):
+    # read the opened power meter every interval s, n times or until stop is set
+    # and at least min_n readings are taken
+    times = []
+    powers = []
+    while True:
+        powers.append(_read_power(tlPM))
+        times.append(time.time())
+        if n is not None and len(powers) >= n:
+            break
+        if stop is not None and stop.is_set() and len(powers) >= min_n:
+            break
+        if stop is None or stop.is_set():
+            time.sleep(interval)
+        elif stop.wait(interval) and len(powers) >= min_n:
+            break
+    return pd.DataFrame({"Host time": times, "Power": powers})
+
+def measurements(tcp_ip_address, control_port, counts_port, N, number_of_detectors, Ib, waves, db, laserip,laserchannel, websq=None, writer=None,
+                 count_filter=None, concurrent=False, power_interval=0.5, settling=None, count_settling=None,
+                 settle_timeout=11, min_power_readings=None):
     
     """
-    Measure the counts for a range of wavelengths, output an xlsx file for each wavelength
-    Measure the power in the reference arm during the measurements, output a final xlsx file with the fluctuations
+    Measure the counts for a range of wavelengths, output a file for each wavelength
+    Measure the power in the reference arm during the measurements, output a final file with the fluctuations
     
     INPUT:
         tcp_ip_address (STR)
@@ -439,6 +669,28 @@ def measurements(tcp_ip_address, control_port, counts_port, N, number_of_detecto
         db = a set attenuation level (INT)
         laserip (STR)
         laserchannel (INT) 
+        websq = open session from snspd_session(), if None one connection is used for all wavelengths
+        writer = ResultWriter saving the results in the background, default ResultWriter.instance()
+        count_filter = CountFilter applied at every wavelength, see detected_counts
+        concurrent = read the power meter while the counts are acquired, over the same time
+                     window, instead of using the settled readings taken before the counts
+        power_interval = time between two power readings in s, with concurrent shortened
+                         to fit min_power_readings into the acquisition
+        min_power_readings = with concurrent, readings taken at least per wavelength (the
+                             power meter is read on after the counts if needed), default
+                             as many as the settled window holds
+        settling = SettlingDetector for the power after a wavelength change, default
+                   SettlingDetector(abs_tol=1e-9): 0.5 % or 1 nW
+        count_settling = SettlingDetector for the total counts, None does not wait for the counts
+        settle_timeout = maximal settling time per wavelength in s, the measurement goes on
+                         (with a warning) when it is reached. Default the 11 s waited before
+        
+    OUTPUT:
+        blocks = LIST of CountBlocks, one per wavelength (metadata wavelength), with the
+                 host receive time of every frame in block.host_times
+        pf = DataFrame with the power readings in the reference arm per wavelength
+        power = LIST of DataFrames, one per wavelength, with "Host time" (time.time())
+                and "Power" of every reading in the reference arm
     """
     
     from ctypes import c_uint32,byref,create_string_buffer,c_bool,c_char_p,c_int,c_double,c_int16
@@ -461,71 +713,84 @@ def measurements(tcp_ip_address, control_port, counts_port, N, number_of_detecto
     for i in range(0, deviceCount.value):
         tlPM.getRsrcName(c_int(i), resourceName1)
         
-    # create a df each column containing the efficiency of all detectors per wavelength
-    df2 = pd.DataFrame(columns = waves)    
-        
-    pf = pd.DataFrame(columns = waves)
-
-    for wave in waves:
-
-        l.setWVL(wave)
-        d.setAtt(db)    
-        d.setWVL(wave)
-        
-        print("================================")
-        print("The wavelength is now set to:",l.getWVL())
-
-        j=0
-        time.sleep(10) # let it calibrate
-        #set wavelength power meter
-        tlPM.open(resourceName1, c_bool(True), c_bool(True))
-        # set wavelength
-        waveset =  c_double(wave)
-        tlPM.setWavelength(waveset)
-        
-        print(tlPM.setWavelength(waveset))
-        print(waveset.value)
-        
-        time.sleep(1)
-        power_fluct = np.zeros(10)            
-            
-        while j<10:
+    if settling is None:
+        # 1 nW: resolution of the power meter, a (nearly) dark reference arm settles too
+        settling = SettlingDetector(abs_tol=1e-9)
+    if min_power_readings is None:
+        min_power_readings = settling.window
+    blocks = []
+    power = []
+
+    with _session(websq, tcp_ip_address, control_port, counts_port) as websq:
+        for wave in waves:
+
+            l.setWVL(wave)
+            d.setAtt(db)    
+            d.setWVL(wave)
+        
+            print("================================")
+            print("The wavelength is now set to:",l.getWVL())
+
+            #set wavelength power meter
+            tlPM.open(resourceName1, c_bool(True), c_bool(True))
+            # set wavelength
+            waveset =  c_double(wave)
+            tlPM.setWavelength(waveset)
+        
+            print(tlPM.setWavelength(waveset))
+            print(waveset.value)
+        
+            # let it calibrate: wait until the power (and counts) stop changing
+            signals = dict(power=(lambda: _read_power(tlPM), settling))
+            if count_settling is not None:
+                signals["counts"] = (lambda: websq.aquire_cnts(1)[0, 1:].sum(), count_settling)
+            for read, detector in signals.values():
+                detector.reset()
+            settled, elapsed = wait_settled(signals, power_interval, settle_timeout)
+            if settled:
+                print("Settled after %.1f s" % elapsed)
+            else:
+                warnings.warn("%g nm not settled after %.1f s" % (wave, elapsed))
             
-            power =  c_double()
-            tlPM.measPower(byref(power))
-        
-            print(power.value)
-        
-            p = power.value        
-            
-            power_fluct[j]=p
-            time.sleep(0.5)
+            if concurrent:
+                # both instruments watch the same light over the same time window
+                acquisition = (N + 1)*websq.get_measurement_periode()*10**(-3)
+                interval = min(power_interval, acquisition/min_power_readings)
+                stop = threading.Event()
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    sampling = pool.submit(_sample_power, tlPM, None, interval, stop, min_power_readings)
+                    try:
+                        block = _detected_counts(websq, N, number_of_detectors, Ib, wave, writer, count_filter)
+                    finally:
+                        stop.set()
+                    series = sampling.result()
+                tlPM.close()
+                p = series["Power"].mean()
+            else:
+                # the readings of the settled window
+                series = pd.DataFrame({"Host time": list(settling.times), "Power": list(settling.values)})
+                tlPM.close() 
+                p = series["Power"].mean()
+                
+                # get detected counts of the SNSPD system, N measurements for all detectors
+                block = _detected_counts(websq, N, number_of_detectors, Ib, wave, writer, count_filter)
             print(p)
-            
-            j = j+1
-        tlPM.close() 
-        
-        power_fluct2=power_fluct[3:]
-        p = np.average(power_fluct2)
-        print(p)
-        
-        # get detected counts of the SNSPD system, only average counts of N measurements for all detectors
-        SNSPD_counts = detected_counts(tcp_ip_address, control_port, counts_port,N, number_of_detectors, Ib, wave)[0].tolist()
-        print(SNSPD_counts)
+            print(block.mean())
         
-        df2[wave]=SNSPD_counts
-        pf[wave] = power_fluct
+            blocks.append(block)
+            power.append(series)
         
-    # drop first row containing timestamps
-    df2 = df2.iloc[1:,:]
-    df2.to_excel("measurements.xlsx")
+    pf = pd.DataFrame(dict((wave, series["Power"]) for wave, series in zip(waves, power)))
+    # a df each column containing the average count rate of all detectors per wavelength
+    df2 = mean_table(blocks, "wavelength")
+    writer = writer or ResultWriter.instance()
+    writer.write(df2, "measurements")
  
-    pf = pf.iloc[1:,:]
-    pf.to_excel("powerfluctuationsf.xlsx")
+    writer.write(pf, "powerfluctuationsf")
     print(df2)
     print(pf)
     
-    return df2, pf
+    return blocks, pf, power
 
 def setattenuator(db,wav):
     """
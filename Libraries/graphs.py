@@ -1,20 +1,24 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from countblock import CountBlock
+from writer import ResultWriter
 
 def count_rate_plotter(avgscounts, xIb, number_of_detectors):
     """
     Plot the count rate for different currents
     
     INPUT:
-        avgscounts = nested LIST of counts
+        avgscounts = LIST of CountBlocks from count_rate, a flat LIST of counts,
+                     or the means (points, detectors) from bias_sweep
         xIb = LIST of currents for x-scale
         number_of_detectors (INT)           
     """
+    if len(avgscounts) and isinstance(avgscounts[0], CountBlock):
+        avgscounts = [block.mean() for block in avgscounts]
+    avgscounts = np.asarray(avgscounts).reshape(len(xIb), -1)
     for k in range(0, number_of_detectors):
-        newlist = []
-        for i in range(k, len(avgscounts), 8):
-            newlist.append(avgscounts[i])
+        newlist = avgscounts[:, k]
             
         plt.title("Count rate vs I_bias")    
         plt.plot(xIb, newlist,label = "Detector "+str(k+1))  
@@ -162,7 +166,7 @@ def laser_stability_plot(df, waves):
     data["std deviations"] = deviations
     data["%"] = perc
     data.index = ([i for i in df])
-    data.to_excel("plot_data.xlsx")
+    ResultWriter.instance().write(data, "plot_data")
     
     return averages, deviations, perc, data
         
@@ -219,13 +223,14 @@ def measurements_plotter(counts_meas, laspower, times, number_of_detectors):
     plt.show()
     plt.close()
     
-def getratios2(df1, df2):
+def getratios2(df1, df2, writer=None):
     """
     Calculate the ratios between the measured powers from the two powermeters for each wavelength
     
     INPUT:
         df1 = DataFrame 1 for power meter 1, reference arm
         df2 = DataFrame 2 for power meter 2, measurement arm
+        writer = ResultWriter saving the ratios in the background, default ResultWriter.instance()
     
     OUTPUT:
         ratios = LIST containing the ratios between the measured power meters
@@ -255,7 +260,7 @@ def getratios2(df1, df2):
     ratiosdf["Ratios"]=ratios 
     ratiosdf["dB ratios"] = dbratios
     ratiosdf.index = ([i for i in df1])
-    ratiosdf.to_excel("ratios.xlsx")
+    (writer or ResultWriter.instance()).write(ratiosdf, "ratios")
     return ratios, dbratios
 
 def ploteffwav(waves, efficiency, i):
@@ -268,7 +273,7 @@ def ploteffwav(waves, efficiency, i):
     plt.savefig("Efficiency.png")
     
       
-def photon_eff(wav, ratios, pwrs, number_of_detectors, detected_counts, j):
+def photon_eff(wav, ratios, pwrs, number_of_detectors, detected_counts, j, writer=None):
     """ 
     This function calculates the efficiency of the system for a range of wavelenghts 
     
@@ -286,6 +291,7 @@ def photon_eff(wav, ratios, pwrs, number_of_detectors, detected_counts, j):
         number_of_detectors = INT
         detected_counts = LIST
         j = number for naming
+        writer = ResultWriter saving the analysis in the background, default ResultWriter.instance()
         
     """
     analysis = pd.DataFrame()
@@ -321,6 +327,6 @@ def photon_eff(wav, ratios, pwrs, number_of_detectors, detected_counts, j):
     analysis["Measured Photon count"] =   detected_counts     
     analysis["Efficiency"] = efficiency
     analysis.index = ([i for i in wav])
-    analysis.to_excel("analysis"+str(wav[0])+"V"+str(j+1)+".xlsx")
+    (writer or ResultWriter.instance()).write(analysis, "analysis"+str(wav[0])+"V"+str(j+1))
     
     return total_photons, efficiency
\ No newline at end of file
@@ -0,0 +1,143 @@
+"""
+Append-only binary recording of raw SNSPD count streams.
+
+File layout:
+    8 bytes     magic b"SQCNTS01"
+    4 bytes     header length H in bytes (little endian uint32), including magic and length
+    H-12 bytes  JSON metadata, padded with spaces
+    records     little endian float64, timestamp followed by the counts of every detector
+
+The records have a fixed width, so a recording can be opened with np.memmap
+without reading it into memory, also while it is still being written.
+
+    with CountsRecorder(websq, "run1.sqcnts", metadata=dict(wavelength=1550)) as rec:
+        time.sleep(3600)
+    meta, cnts = read_recording("run1.sqcnts")
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+import numpy as np
+
+from WebSQControl import SQTimeoutError
+
+MAGIC = b"SQCNTS01"
+DTYPE = np.dtype("<f8")
+
+def _header(metadata):
+    meta = bytes(json.dumps(metadata), "utf-8")
+    length = len(MAGIC) + 4 + len(meta)
+    #Pad to a multiple of 512 bytes so the records are aligned
+    length = -(-length//512)*512
+    return MAGIC + struct.pack("<I", length) + meta.ljust(length - len(MAGIC) - 4)
+
+def read_header(path):
+    """Return the metadata (DICT) and header length (INT) of a recording."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError(path + " is not a counts recording")
+        length = struct.unpack("<I", f.read(4))[0]
+        meta = json.loads(str(f.read(length - len(MAGIC) - 4), "utf-8"))
+    return meta, length
+
+def read_recording(path):
+    """
+    Map a recording into memory without copying it.
+
+    OUTPUT:
+        meta = metadata stored in the header (DICT)
+        cnts = read-only np.memmap, timestamp in first column, one row per measurement.
+               A partially written last record is ignored.
+    """
+    meta, length = read_header(path)
+    ncols = meta["columns"]
+    nrec = (os.path.getsize(path) - length)//(ncols*DTYPE.itemsize)
+    if nrec == 0:
+        return meta, np.zeros((0, ncols), dtype=DTYPE)
+    return meta, np.memmap(path, dtype=DTYPE, mode="r", offset=length, shape=(nrec, ncols))
+
+class CountsRecorder(object):
+    """
+    Tee the counts stream of a connected WebSQControl into a recording file.
+
+    Frames are taken from a blocking stream, so nothing is lost: if the disk
+    can not keep up the counts socket is throttled instead.
+
+    INPUT:
+        websq = connected WebSQControl
+        path = file name, an existing file is overwritten
+        metadata = DICT stored in the header, e.g. bias current, wavelength
+        maxsize = number of frames queued between the socket and the disk
+    """
+    def __init__(self, websq, path, metadata = None, maxsize = 100000):
+        self.websq = websq
+        self.path = path
+        self.metadata = dict(metadata or {})
+        self.maxsize = maxsize
+        self.records = 0
+        self.shutdown = False
+        self.thread = None
+        #Exception which ended the recording, raised again by stop()
+        self.error = None
+
+    def start(self):
+        meta = dict(address=self.websq.TCP_IP_ADR,
+                    number_of_detectors=self.websq.NUMBER_OF_DETECTORS,
+                    columns=self.websq.NUMBER_OF_DETECTORS + 1,
+                    dtype=DTYPE.str,
+                    measurement_periode_ms=self.websq.get_measurement_periode(),
+                    started=time.time())
+        meta.update(self.metadata)
+        self.file = open(self.path, "wb")
+        self.file.write(_header(meta))
+        self.columns = meta["columns"]
+
+        self.stream = self.websq.stream_counts(maxsize=self.maxsize, overflow="block")
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop recording, write the frames still queued and close the file.
+        Raises the error which ended the recording early, e.g. a full disk."""
+        self.websq.cnts.unsubscribe(self.stream)
+        self.shutdown = True
+        self.thread.join()
+        self.stream.close()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _write(self, frames):
+        if frames.shape[1] != self.columns:
+            raise IOError("Frame with %d columns, recording has %d" % (frames.shape[1], self.columns))
+        self.file.write(np.ascontiguousarray(frames, dtype=DTYPE).tobytes())
+        self.records += len(frames)
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    frames = self.stream.get(timeout=0.1)
+                except SQTimeoutError:
+                    if self.shutdown:
+                        break
+                    continue
+                if frames is None:
+                    break
+                self._write(frames)
+            self.file.flush()
+        except Exception as e:
+            #A blocking stream nobody reads would pause the counts socket for everybody
+            self.error = e
+            self.stream.close()
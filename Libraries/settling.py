@@ -0,0 +1,85 @@
+"""
+Decide when a signal has settled after a change, instead of sleeping a fixed time.
+
+A SettlingDetector keeps the last readings of a signal (e.g. the power meter
+after a wavelength change) and calls it settled once, over this rolling
+window, both the drift (slope of a straight line fit times the window length)
+and the standard deviation are small compared to the mean, or below an
+absolute tolerance such as the resolution of the instrument (for readings
+close to zero).
+
+    power = SettlingDetector(window=6, max_drift=0.005, max_std=0.005, abs_tol=1e-9)
+    settled, elapsed = wait_settled(dict(power=(read_power, power)), interval=0.5, timeout=11)
+"""
+
+import collections
+import time
+import numpy as np
+
+class SettlingDetector(object):
+    """
+    INPUT:
+        window = number of readings judged together
+        max_drift = allowed change over the window, relative to the mean
+        max_std = allowed standard deviation, relative to the mean
+        abs_tol = drift and standard deviation below this value are always accepted,
+                  e.g. the resolution of the instrument, in the unit of the readings
+    """
+    def __init__(self, window = 6, max_drift = 0.005, max_std = 0.005, abs_tol = 0.):
+        if window < 3:
+            raise ValueError("window must hold at least 3 readings")
+        self.window = window
+        self.max_drift = max_drift
+        self.max_std = max_std
+        self.abs_tol = abs_tol
+        self.times = collections.deque(maxlen=window)
+        self.values = collections.deque(maxlen=window)
+
+    def reset(self):
+        self.times.clear()
+        self.values.clear()
+
+    def add(self, t, value):
+        """Add a reading taken at time t (s)."""
+        self.times.append(t)
+        self.values.append(value)
+
+    def state(self):
+        """Mean, standard deviation and drift of the window, None while it is not full."""
+        if len(self.values) < self.window:
+            return None
+        t = np.array(self.times) - self.times[0]
+        v = np.array(self.values, dtype=float)
+        slope = np.polyfit(t, v, 1)[0] if t[-1] > 0 else 0.
+        return dict(mean=v.mean(), std=v.std(ddof=1), drift=abs(slope)*t[-1])
+
+    @property
+    def settled(self):
+        state = self.state()
+        if state is None:
+            return False
+        scale = abs(state["mean"])
+        return state["std"] <= max(self.max_std*scale, self.abs_tol) and \
+            state["drift"] <= max(self.max_drift*scale, self.abs_tol)
+
+def wait_settled(signals, interval = 0.5, timeout = 11.):
+    """
+    Read all signals every interval s until all of them have settled.
+
+    INPUT:
+        signals = DICT name -> (read, SettlingDetector), read() returns the present value
+        interval = time between readings in s
+        timeout = maximal waiting time in s
+    OUTPUT:
+        settled = False if the timeout was reached first
+        elapsed = waiting time in s
+    """
+    start = time.time()
+    while True:
+        for read, detector in signals.values():
+            detector.add(time.time(), read())
+        if all(detector.settled for read, detector in signals.values()):
+            return True, time.time() - start
+        if time.time() - start + interval > timeout:
+            return False, time.time() - start
+        time.sleep(interval)
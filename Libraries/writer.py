@@ -0,0 +1,246 @@
+"""
+Write measurement results in the background.
+
+Results (DataFrames or CountBlocks) are put on a queue and written to disk by
+one thread, so a scan does not wait for the file system or for openpyxl.
+
+    writer = ResultWriter(format="parquet", excel=True)
+    writer.write(block, "counts1550")      # returns at once, writes counts1550.parquet and .xlsx
+    writer.flush()                         # wait until everything is on disk
+    block = read_result("counts1550.parquet")
+
+Formats:
+    parquet, feather   columnar, need pyarrow
+    npz                numpy only
+In every format a CountBlock keeps its raw counts, host times and metadata
+and is read back as a CountBlock. Excel is only written as an additional
+export of the count rates (excel=True), it is slow to write and to read back.
+
+The functions in functions.py and graphs.py use ResultWriter.instance() unless
+a writer is given. It writes parquet if pyarrow is installed and npz otherwise,
+and is flushed when the program exits.
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import numpy as np
+
+from countblock import CountBlock
+
+FORMATS = ("parquet", "feather", "npz")
+
+def _default_format():
+    try:
+        import pyarrow
+    except ImportError:
+        return "npz"
+    return "parquet"
+
+def _json_default(obj):
+    #numpy values in the metadata
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+def _as_frame(result):
+    if isinstance(result, CountBlock):
+        return result.to_frame()
+    return result
+
+def _npz_arrays(name, values):
+    #np.load can not read object arrays (e.g. channel names) without pickle, store them as JSON
+    values = np.asarray(values)
+    if values.dtype == object:
+        return {name + "_json": json.dumps(values.tolist(), default=_json_default)}
+    return {name: values}
+
+def _npz_read(f, name):
+    if name + "_json" in f:
+        return np.array(json.loads(str(f[name + "_json"])), dtype=object)
+    return f[name]
+
+def _write_npz(result, path):
+    if isinstance(result, CountBlock):
+        extra = dict() if result.host_times is None else dict(host_times=result.host_times)
+        np.savez(path, kind="CountBlock", timestamps=result.timestamps, counts=result.counts,
+                 channels=np.array(result.channels),
+                 metadata=json.dumps(result.metadata, default=_json_default), **extra)
+        return
+    columns = list(result.columns)
+    arrays = _npz_arrays("index", result.index.to_numpy())
+    for i in range(len(columns)):
+        arrays.update(_npz_arrays("column_%d" % i, result.iloc[:, i].to_numpy()))
+    np.savez(path, kind="DataFrame", columns=json.dumps(columns, default=_json_default), **arrays)
+
+def _block_table(block):
+    #Raw counts, one column per channel, channel names and metadata in the schema metadata
+    import pyarrow as pa
+    names = ["Timestamp"]
+    arrays = [block.timestamps]
+    if block.host_times is not None:
+        names.append("Host time")
+        arrays.append(block.host_times)
+    for i, channel in enumerate(block.channels):
+        names.append(str(channel))
+        arrays.append(block.counts[:, i])
+    info = json.dumps(dict(channels=block.channels, metadata=block.metadata), default=_json_default)
+    return pa.Table.from_arrays([pa.array(a) for a in arrays], names=names,
+                                metadata={b"CountBlock": info.encode("utf-8")})
+
+def _read_block(table):
+    info = json.loads(table.schema.metadata[b"CountBlock"].decode("utf-8"))
+    channels = info["channels"]
+    counts = np.column_stack([table.column(str(c)).to_numpy() for c in channels]) if channels \
+        else np.zeros((table.num_rows, 0))
+    host_times = table.column("Host time").to_numpy() if "Host time" in table.column_names else None
+    return CountBlock(table.column("Timestamp").to_numpy(), counts, channels, info["metadata"], host_times)
+
+def _write_columnar(result, path, fmt):
+    import pyarrow as pa
+    if isinstance(result, CountBlock):
+        table = _block_table(result)
+    else:
+        df = result.copy()
+        #pyarrow only takes string column names, e.g. not the wavelengths
+        df.columns = [str(c) for c in df.columns]
+        table = pa.Table.from_pandas(df)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(table, path)
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather(table, path)
+
+def _restore_columns(df):
+    #column names written as strings by _write_columnar, e.g. wavelengths
+    def restore(name):
+        for convert in (int, float):
+            try:
+                return convert(name)
+            except ValueError:
+                pass
+        return name
+    df.columns = [restore(c) for c in df.columns]
+    return df
+
+def read_result(path):
+    """
+    Read a result written by ResultWriter.
+
+    OUTPUT:
+        a CountBlock for blocks (except from xlsx), a DataFrame otherwise
+    """
+    import pandas as pd
+    ext = os.path.splitext(path)[1]
+    if ext in (".parquet", ".feather"):
+        if ext == ".parquet":
+            import pyarrow.parquet as pq
+            table = pq.read_table(path)
+        else:
+            import pyarrow.feather as feather
+            table = feather.read_table(path)
+        if table.schema.metadata and b"CountBlock" in table.schema.metadata:
+            return _read_block(table)
+        return _restore_columns(table.to_pandas())
+    if ext == ".xlsx":
+        return pd.read_excel(path, index_col=0)
+    if ext != ".npz":
+        raise ValueError("Unknown result format " + ext)
+    with np.load(path) as f:
+        if str(f["kind"]) == "CountBlock":
+            return CountBlock(f["timestamps"], f["counts"], list(f["channels"]),
+                              json.loads(str(f["metadata"])),
+                              f["host_times"] if "host_times" in f else None)
+        columns = json.loads(str(f["columns"]))
+        data = dict((c, _npz_read(f, "column_%d" % i)) for i, c in enumerate(columns))
+        return pd.DataFrame(data, index=_npz_read(f, "index"), columns=columns)
+
+class ResultWriter(object):
+    """
+    INPUT:
+        directory = where the files are written
+        format = "parquet", "feather" or "npz", default parquet if pyarrow is installed
+        excel = also write every result as xlsx
+        maxsize = number of results queued before write() blocks
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """The writer shared by functions.py and graphs.py, flushed at exit."""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                atexit.register(cls._instance.close)
+            return cls._instance
+
+    def __init__(self, directory = ".", format = None, excel = False, maxsize = 100):
+        if format is None:
+            format = _default_format()
+        if format not in FORMATS:
+            raise ValueError("format must be one of " + ", ".join(FORMATS))
+        self.directory = directory
+        self.format = format
+        self.excel = excel
+        self.queue = queue.Queue(maxsize)
+        self.written = []
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, name="ResultWriter")
+        #Daemonic Thread close when main progam is closed, close() writes what is queued
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, result, name):
+        """
+        Queue result (DataFrame or CountBlock) to be written as name + extension.
+        Returns at once, unless maxsize results are already waiting.
+        """
+        if not self.thread.is_alive():
+            raise IOError("ResultWriter is closed")
+        self.queue.put((result, name))
+
+    def flush(self):
+        """Wait until all queued results are written, raise the first error since the last flush."""
+        self.queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise IOError("Writing %d result(s) failed, first: %s" % (len(errors), errors[0]))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, result, name):
+        path = os.path.join(self.directory, name)
+        if self.format == "npz":
+            _write_npz(result, path + ".npz")
+        else:
+            _write_columnar(result, path + "." + self.format, self.format)
+        self.written.append(path + "." + self.format)
+        if self.excel:
+            _as_frame(result).to_excel(path + ".xlsx")
+            self.written.append(path + ".xlsx")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self._write(*item)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
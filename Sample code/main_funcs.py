@@ -35,6 +35,17 @@ Making the connection check with the system (should include all devices!):
 """
 ms_time, bias_current, trigger, number_of_detectors = funcs.start_snspd(N, tcp_ip_address, control_port, counts_port) # retrieves import exp parameters
 
+# one connection to the SNSPD driver, reused by all measurements below
+websq = funcs.snspd_session(tcp_ip_address, control_port, counts_port)
+
+# results are written in the background (parquet, or npz without pyarrow),
+# also keep Excel copies for main_graphs.py
+funcs.ResultWriter.instance().excel = True
+
+# remove noise: only detector 7 is in use, frames below 20000 counts/s are rejected
+# add more rules (outliers, latch) or channels if more ports are used
+noise = funcs.CountFilter().threshold("Channel 7", min=20000)
+
 #%%
 """
 Setting more variables as the user wishes. Giving option to:
@@ -76,13 +87,28 @@ meas_times = np.linspace(0,10,20)
 get N counts for all detectors using a set bias current
 """
 # acquire N counts for all detectors using a set bias current
-avgs_detect, df =funcs.detected_counts(tcp_ip_address, control_port, counts_port,N, number_of_detectors, std_bias,0)
+block =funcs.detected_counts(tcp_ip_address, control_port, counts_port,N, number_of_detectors, std_bias,0, websq=websq, count_filter=noise)
+avgs_detect = block.mean()
+df = block.to_frame()
+
+# or: let the measurement period and N follow from the wanted precision (1 % for detector 7)
+plan = funcs.plan_acquisition(websq, 0.01, detectors=[6])
+N = plan["frames"]
 
 #%%
 """
 get count rate for a range of current values at a set wavelength (not specified, should be set manually)
 """
-avgscounts = funcs.count_rate(tcp_ip_address, control_port, counts_port,list_Ib, N, number_of_detectors)
+blocks = funcs.count_rate(tcp_ip_address, control_port, counts_port,list_Ib, N, number_of_detectors, websq=websq, count_filter=noise)
+graphs.count_rate_plotter(blocks, xIb, number_of_detectors)
+
+# or: all counts of the sweep in one array, without writing files
+counts, means = funcs.bias_sweep(websq, xIb, N)
+graphs.count_rate_plotter(means, xIb, number_of_detectors)
+
+# or: adaptive sweep, most of the points around the knee of the curve
+xIb_adaptive, counts, means = funcs.adaptive_bias_sweep(websq, 0, 40, N)
+graphs.count_rate_plotter(means, xIb_adaptive, number_of_detectors)
 
 #%%
 """
@@ -110,4 +136,11 @@ dflaserP1, dflaserP2, laserlistP1, laserlistP2 = funcs.calibration(cali_waves4,
 """
 SNSPD counts for range of wavelengths, also measuring power
 """
-snspdcounts, powerfluctuations = funcs.measurements(tcp_ip_address, control_port, counts_port, N, number_of_detectors, Ib, waves, db, laserip,laserchannel)
\ No newline at end of file
+# the reference power is read while the counts are acquired, power holds the readings with their time
+snspdcounts, powerfluctuations, power = funcs.measurements(tcp_ip_address, control_port, counts_port, N, number_of_detectors, Ib, waves, db, laserip,laserchannel, websq=websq, count_filter=noise, concurrent=True)
+
+#%%
+"""
+Close the connection to the SNSPD driver
+"""
+websq.close()
\ No newline at end of file
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+#The libraries are imported by module name, as in the sample code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Libraries"))
+
+from WebSQControl import WebSQControl
+from WebSQSimulator import WebSQSimulator
+
+@pytest.fixture
+def sim():
+    """Simulated driver with 4 detectors and 10 ms frames, on free ports."""
+    sim = WebSQSimulator(control_port=0, counts_port=0, number_of_detectors=4, period_ms=10,
+                         autoiv_time=0, seed=1).start()
+    yield sim
+    sim.stop()
+
+@pytest.fixture
+def websq(sim):
+    websq = WebSQControl(CONTROL_PORT=sim.control_port, COUNTS_PORT=sim.counts_port)
+    websq.connect()
+    yield websq
+    websq.close()
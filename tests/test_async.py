@@ -0,0 +1,46 @@
+"""
+Tests of AsyncWebSQControl against the WebSQSimulator.
+"""
+
+import asyncio
+import time
+import pytest
+
+from AsyncWebSQControl import AsyncWebSQControl
+from WebSQControl import SQTimeoutError
+from WebSQSimulator import WebSQSimulator
+
+def run(sim, fn, **kwargs):
+    async def main():
+        async with AsyncWebSQControl(CONTROL_PORT=sim.control_port, COUNTS_PORT=sim.counts_port, **kwargs) as websq:
+            return await fn(websq)
+    return asyncio.run(main())
+
+def test_acquire(sim):
+    async def fn(websq):
+        await websq.enable_detectors(True)
+        await websq.set_bias_current([25.]*4)
+        return websq.NUMBER_OF_DETECTORS, await websq.aquire_cnts(5, timeout=5)
+    detectors, cnts = run(sim, fn)
+    assert detectors == 4
+    assert cnts.shape == (5, 5)
+    assert (cnts[1:, 0] > cnts[:-1, 0]).all()
+
+def test_more_frames_than_buffer_fail_fast(sim):
+    async def fn(websq):
+        await websq.aquire_cnts(1, timeout=5)
+        start = time.time()
+        with pytest.raises(ValueError):
+            await websq.aquire_cnts(150)
+        return time.time() - start
+    assert run(sim, fn) < 0.1
+
+def test_silent_stream_raises():
+    with WebSQSimulator(control_port=0, counts_port=0, number_of_detectors=4, period_ms=60000) as sim:
+        async def fn(websq):
+            websq.STALL_TIMEOUT = 0.3
+            start = time.time()
+            with pytest.raises(SQTimeoutError):
+                await websq.aquire_cnts(1)
+            return time.time() - start
+        assert 0.3 <= run(sim, fn) < 1
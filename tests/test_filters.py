@@ -0,0 +1,34 @@
+"""
+Tests of the CountFilter rules.
+"""
+
+import numpy as np
+
+from countblock import CountBlock
+from filters import CountFilter
+
+def test_mad_filter_on_constant_channel():
+    counts = np.full((50, 2), 100.)
+    counts[10, 0] = 1000
+    block = CountBlock(np.arange(50), counts)
+    kept, rejected = CountFilter().outliers().apply(block)
+    assert rejected == {"mad": 1, "total": 1}
+
+def test_latch_only_in_the_given_channels():
+    counts = np.full((10, 3), 100.)
+    counts[:, 0] = 0          # unused detector
+    counts[4:7, 1] = 0        # latched for three frames
+    counts[8, 1] = 0          # a single dark frame
+    block = CountBlock(np.arange(10), counts)
+    kept, rejected = CountFilter().latch("Channel 2", min_run=3).apply(block)
+    assert rejected == {"latch": 3, "total": 3}
+    assert kept.timestamps.tolist() == [0, 1, 2, 3, 7, 8, 9]
+
+def test_docstring_example():
+    counts = np.full((10, 8), 0.)
+    counts[:, 6] = 30000
+    counts[2, 6] = 100
+    block = CountBlock(np.arange(10), counts, metadata=dict(measurement_periode_ms=1000))
+    noise = CountFilter().threshold("Channel 7", min=20000).latch("Channel 7", min_run=3)
+    kept, rejected = noise.apply(block)
+    assert rejected == {"threshold Channel 7": 1, "latch": 0, "total": 1}
@@ -0,0 +1,46 @@
+"""
+Tests of SNSPDFleet against two WebSQSimulators.
+"""
+
+import time
+import numpy as np
+import pytest
+
+from WebSQSimulator import WebSQSimulator
+from fleet import SNSPDFleet
+
+@pytest.fixture
+def fleet():
+    sims = dict((name, WebSQSimulator(control_port=0, counts_port=0, number_of_detectors=detectors,
+                                      period_ms=period, autoiv_time=0.3, seed=1).start())
+                for name, detectors, period in (("cryo1", 2, 10), ("cryo2", 3, 20)))
+    fleet = SNSPDFleet(dict((name, ("localhost", sim.control_port, sim.counts_port)) for name, sim in sims.items()))
+    with fleet:
+        yield fleet
+    for sim in sims.values():
+        sim.stop()
+
+def test_configure(fleet):
+    confirmed = fleet.configure(bias=dict(cryo1=20, cryo2=[21, 22, 23]), period=30, enable=True)
+    assert confirmed["cryo1"]["BiasCurrent"] == [20, 20]
+    assert confirmed["cryo2"]["BiasCurrent"] == [21, 22, 23]
+    assert all(c["InptMeasurementPeriod"] == 30 for c in confirmed.values())
+    assert fleet.number_of_detectors() == dict(cryo1=2, cryo2=3)
+
+def test_aquire_cnts_starts_after_the_call(fleet):
+    fleet.configure(bias=25, period=50, enable=True)
+    t0 = time.time()
+    cnts = fleet.aquire_cnts(3, timeout=5)
+    for name, detectors in (("cryo1", 2), ("cryo2", 3)):
+        block = cnts[name]
+        assert sorted(block) == ["Channel %d" % (i + 1) for i in range(detectors)] + ["Host time", "Timestamp"]
+        # every frame was integrated entirely after t0
+        assert (block["Host time"] > t0 + 0.05).all()
+        assert len(block["Channel 1"]) == 3
+
+def test_auto_calibrate_in_parallel(fleet):
+    start = time.time()
+    currents = fleet.auto_calibrate(100, timeout=5)
+    assert time.time() - start < 0.6
+    assert [len(currents[name]) for name in ("cryo1", "cryo2")] == [2, 3]
+    assert np.all(np.array(currents["cryo2"]) > 0)
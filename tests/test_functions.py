@@ -0,0 +1,64 @@
+"""
+Tests of the measurement functions against the WebSQSimulator.
+"""
+
+import sys
+import types
+import pytest
+
+import functions as funcs
+from settling import SettlingDetector
+from writer import ResultWriter
+
+def test_plan_without_counts_changes_nothing(websq):
+    websq.enable_detectors(False, confirm=True)
+    with pytest.raises(ValueError):
+        funcs.plan_acquisition(websq, 0.01)
+    assert websq.get_measurement_periode() == 10
+
+def test_plan_ignores_dark_channels(websq):
+    rates = [50., 50., 1e6, 50.]
+    dark = funcs.plan_acquisition(websq, 0.01, pilot_rates=rates, apply=False)
+    lit = funcs.plan_acquisition(websq, 0.01, pilot_rates=rates, detectors=[2], apply=False)
+    above_dark = funcs.plan_acquisition(websq, 0.01, pilot_rates=rates, min_rate=1000, apply=False)
+    # 1 % needs 10**4 counts: 200 s in a dark channel, 10 ms in the lit one
+    assert dark["time"] >= 200
+    assert lit == above_dark
+    assert lit["time"] == pytest.approx(0.02) and lit["rel_err"][2] < 0.01
+
+class FakeInstrument(object):
+    """Laser, attenuator and power meter in one, records nothing and reads 1 uW."""
+    def __getattr__(self, name):
+        return lambda *args: None
+
+    def findRsrc(self, count):
+        count._obj.value = 1
+
+    def measPower(self, power):
+        power._obj.value = 1e-6
+
+    def getWVL(self):
+        return 1550.
+
+@pytest.fixture
+def instruments(monkeypatch):
+    for module, cls in (("TLPM", "TLPM"), ("laser", "Laser"), ("Attenuator", "Attenuator")):
+        monkeypatch.setitem(sys.modules, module, types.SimpleNamespace(**{cls: FakeInstrument}))
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_measurements_power_readings(websq, instruments, tmp_path, concurrent):
+    # 10 frames of 20 ms take far less than one power_interval of 0.5 s
+    websq.set_measurement_periode(20, confirm=True)
+    websq.enable_detectors(True, confirm=True)
+    with ResultWriter(directory=str(tmp_path), format="npz") as writer:
+        blocks, pf, power = funcs.measurements(None, None, None, 10, 4, [25.]*4, [1550, 1560], 3, None, None,
+                                               websq=websq, writer=writer, concurrent=concurrent,
+                                               settling=SettlingDetector(window=3))
+    assert [len(block) for block in blocks] == [10, 10]
+    for series, block in zip(power, blocks):
+        assert len(series) >= 3
+        if concurrent:
+            # taken while the counts were acquired, not in the settling window before
+            assert series["Host time"].iloc[0] > block.metadata["started"] - 0.1
+            assert series["Host time"].iloc[-1] < block.host_times[-1] + 0.1
+    assert pf.shape == (len(power[0]), 2)
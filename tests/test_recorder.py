@@ -0,0 +1,27 @@
+"""
+Tests of CountsRecorder against the WebSQSimulator.
+"""
+
+import time
+import numpy as np
+import pytest
+
+from recorder import CountsRecorder, read_recording
+
+def test_round_trip(websq, tmp_path):
+    path = str(tmp_path / "run.sqcnts")
+    with CountsRecorder(websq, path, metadata=dict(wavelength=1550)) as rec:
+        time.sleep(0.3)
+    meta, cnts = read_recording(path)
+    assert meta["wavelength"] == 1550 and meta["columns"] == 5
+    assert len(cnts) == rec.records > 10
+    # every frame of the stream, in order
+    assert np.allclose(np.diff(cnts[:, 0]), 10, atol=0.01)
+
+def test_write_error_releases_the_stream(websq, tmp_path):
+    rec = CountsRecorder(websq, str(tmp_path / "run.sqcnts"), maxsize=5).start()
+    rec.columns = 3
+    # the failed recorder must not pause the counts socket
+    assert len(websq.aquire_cnts(20, timeout=2)) == 20
+    with pytest.raises(IOError, match="columns"):
+        rec.stop()
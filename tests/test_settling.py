@@ -0,0 +1,47 @@
+"""
+Tests of SettlingDetector and wait_settled.
+"""
+
+import itertools
+import numpy as np
+import pytest
+
+from settling import SettlingDetector, wait_settled
+
+def fill(detector, values):
+    detector.reset()
+    for t, v in enumerate(values):
+        detector.add(0.5*t, v)
+    return detector.settled
+
+def test_settled_only_with_a_full_quiet_window():
+    detector = SettlingDetector(window=6)
+    assert not fill(detector, [1e-3]*5)
+    assert fill(detector, [1e-3]*6)
+    # 0.1 % noise is within 0.5 %, 1 % drift over the window is not
+    noise = 1e-3*(1 + 1e-3*np.random.default_rng(1).standard_normal(6))
+    assert fill(detector, noise)
+    assert not fill(detector, 1e-3*np.linspace(1, 1.01, 6))
+    # an old transient leaves the rolling window
+    assert fill(detector, [2e-3, 1.5e-3] + [1e-3]*6)
+
+def test_absolute_tolerance_near_zero():
+    dark = [0., 2e-10, -1e-10, 1e-10, 0., -2e-10]
+    assert not fill(SettlingDetector(), dark)
+    assert fill(SettlingDetector(abs_tol=1e-9), dark)
+
+def test_window_too_short():
+    with pytest.raises(ValueError):
+        SettlingDetector(window=2)
+
+def test_wait_settled():
+    # settles once the step response has decayed
+    readings = iter([5., 3., 2.] + [1.]*10)
+    detector = SettlingDetector(window=3)
+    settled, elapsed = wait_settled(dict(power=(lambda: next(readings), detector)), interval=0.01, timeout=1)
+    assert settled and detector.state()["mean"] == 1.
+    # gives up without waiting past the timeout
+    ramp = itertools.count(1.)
+    settled, elapsed = wait_settled(dict(power=(lambda: next(ramp), SettlingDetector(window=3))),
+                                    interval=0.05, timeout=0.3)
+    assert not settled and elapsed <= 0.3
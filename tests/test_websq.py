@@ -0,0 +1,215 @@
+"""
+Regression tests of WebSQControl and functions.py against the WebSQSimulator,
+no hardware needed. Run with: python -m pytest tests
+"""
+
+import time
+import numpy as np
+import pytest
+
+from WebSQControl import WebSQControl, ChannelStats, CountsRingBuffer, CountsFramer, CountsSubscription, \
+    JSONStreamDecoder, HostTime, SQTimeoutError, SQOverflowError
+from WebSQSimulator import WebSQSimulator
+import functions as funcs
+
+def frames(start, stop, ncols = 3):
+    return np.array([[i]*ncols for i in range(start, stop)], dtype=float)
+
+def test_ring_buffer_wraps():
+    buf = CountsRingBuffer(capacity=5)
+    for i in range(0, 12, 3):
+        buf.append(frames(i, i+3), host_time=100. + i)
+    assert (buf.n, len(buf)) == (12, 5)
+    # frames 7..11 are kept, stored across the end of the storage
+    assert buf.get_range(8, 12)[:, 0].tolist() == [8, 9, 10, 11]
+    assert buf.last(5)[:, 0].tolist() == [7, 8, 9, 10, 11]
+    assert buf.get_host_times(8, 12).tolist() == [106., 109., 109., 109.]
+    assert buf.index_after(8.5) == 9
+    assert buf.index_after(106., column=None) == 9
+    assert buf.index_after(20) == 12
+    with pytest.raises(IndexError):
+        buf.get_range(6, 8)
+    # more frames than the capacity in one append keep the newest
+    buf.append(frames(12, 20))
+    assert buf.n == 20 and buf.last(5)[:, 0].tolist() == [15, 16, 17, 18, 19]
+
+def test_ring_buffer_reallocation_keeps_indices():
+    buf = CountsRingBuffer(capacity=5)
+    buf.append(frames(0, 4))
+    buf.append(frames(4, 5, ncols=2))
+    # the frames of the old width are gone, the absolute index keeps counting
+    assert (buf.n, len(buf)) == (5, 1)
+    with pytest.raises(IndexError):
+        buf.get_range(3, 5)
+    buf.append(frames(5, 7, ncols=2))
+    assert buf.get_range(4, 7)[:, 0].tolist() == [4, 5, 6]
+    assert buf.index_after(-1) == 4
+
+def test_acquired_frames_are_copies(websq):
+    cnts = websq.aquire_cnts(3, timeout=5)
+    gated = websq.aquire_cnts(3, timeout=5, after=HostTime(time.time()))
+    for frames in (cnts, gated):
+        assert not np.shares_memory(frames, websq.cnts.cnts.data)
+
+def test_channel_stats_match_numpy():
+    counts = np.random.default_rng(1).poisson(1000, size=(103, 3)).astype(float)
+    stats = ChannelStats()
+    for i in range(0, len(counts), 10):
+        stats.update(counts[i:i+10])
+    snap = stats.snapshot()
+    assert snap["frames"] == 103
+    assert np.allclose(snap["mean"], counts.mean(axis=0))
+    assert np.allclose(snap["std"], counts.std(axis=0, ddof=1))
+    assert np.allclose(snap["sem"], counts.std(axis=0, ddof=1)/np.sqrt(103))
+    assert np.array_equal(snap["min"], counts.min(axis=0)) and np.array_equal(snap["max"], counts.max(axis=0))
+    assert np.array_equal(snap["total"], counts.sum(axis=0))
+
+def test_count_stats_of_the_stream(websq):
+    with pytest.raises(ValueError):
+        websq.count_stats()
+    websq.enable_stats()
+    cnts = websq.aquire_cnts(10, timeout=5)
+    snap = websq.count_stats(reset=True)
+    assert snap["frames"] >= 10 and len(snap["mean"]) == 4
+    assert websq.count_stats()["frames"] < snap["frames"]
+
+def test_framer_split_reads():
+    data = b"1.0,2,3\n2.0,4,5\n3.0,6,7\n"
+    for size in (1, 2, 5, len(data)):
+        framer = CountsFramer()
+        frames = [framer.feed(data[i:i+size]) for i in range(0, len(data), size)]
+        frames = np.concatenate([f for f in frames if len(f)])
+        assert frames.tolist() == [[1, 2, 3], [2, 4, 5], [3, 6, 7]]
+
+def test_framer_rejects_lines_of_another_width():
+    # a broken first line does not decide the number of columns
+    framer = CountsFramer()
+    assert framer.feed(b"1,2\n3,4,5\n6,7,8\n").tolist() == [[3, 4, 5], [6, 7, 8]]
+    assert (framer.ncols, framer.malformed) == (3, 1)
+    # once established, lines of another width are dropped in any position
+    assert framer.feed(b"9,10,11\n12,13\n14,15,16,17\n18,19,20\n").tolist() == [[9, 10, 11], [18, 19, 20]]
+    assert framer.malformed == 3
+    # also when the total number of values happens to fit
+    assert framer.feed(b"1,2\n3,4,5,6\n").tolist() == []
+    assert framer.malformed == 5
+    framer = CountsFramer(ncols=3)
+    assert framer.feed(b"1,2\n").tolist() == [] and framer.ncols == 3
+
+def test_decoder_split_reads():
+    data = b'{"label":"A","value":1}{"label":"B","value":2}\x17{"label":"C","value":3}\x17'
+    decoder = JSONStreamDecoder()
+    msgs = []
+    for i in range(len(data)):
+        msgs += decoder.feed(data[i:i+1])
+    assert [m["label"] for m in msgs] == ["A", "B", "C"]
+
+def test_subscription_drop_oldest():
+    sub = CountsSubscription(maxsize=5, overflow="drop-oldest")
+    for i in range(0, 9, 3):
+        assert sub.offer(frames(i, i+3))
+    assert (sub.received, sub.dropped) == (9, 4)
+    assert np.concatenate(list(sub.get(0) for i in range(2)))[:, 0].tolist() == [4, 5, 6, 7, 8]
+
+def test_subscription_error():
+    sub = CountsSubscription(maxsize=5, overflow="error")
+    sub.offer(frames(0, 3))
+    sub.offer(frames(3, 6))
+    sub.offer(frames(6, 7))
+    # frames queued before the overflow are delivered, then the loss is reported
+    assert sub.get(0)[:, 0].tolist() == [0, 1, 2]
+    with pytest.raises(SQOverflowError):
+        sub.get(0)
+    assert sub.dropped == 4
+
+def test_subscription_block():
+    sub = CountsSubscription(maxsize=5, overflow="block")
+    resumed = []
+    sub.on_space = resumed.append
+    assert sub.offer(frames(0, 3))
+    assert not sub.offer(frames(3, 6))
+    assert sub.received == 3 and not resumed
+    sub.get(0)
+    assert resumed == [sub]
+    assert sub.offer(frames(3, 6))
+    assert sub.get(0)[:, 0].tolist() == [3, 4, 5]
+
+def test_blocking_stream_loses_nothing(websq):
+    # a slow consumer throttles the socket instead of losing frames
+    with websq.stream_counts(maxsize=5, overflow="block", timeout=5) as stream:
+        received = []
+        for cnts in stream:
+            received.append(cnts)
+            time.sleep(0.05)
+            if sum(len(c) for c in received) >= 30:
+                break
+    stamps = np.concatenate(received)[:, 0]
+    assert np.allclose(np.diff(stamps), 10, atol=0.01)
+    assert stream.dropped == 0 and stream.delivered == len(stamps)
+
+def test_confirm_returns_commanded_value(websq):
+    # a broadcast of the old value just before the command must not confirm it
+    websq.set_bias_current([5.]*4, confirm=True)
+    websq.talk.send('{"request":"BiasCurrent"}')
+    assert websq.set_bias_current([9.]*4, confirm=True) == [9.]*4
+    with websq.batch() as batch:
+        batch.set_bias_current([1.]*4)
+        batch.set_bias_current([2.]*4)
+        batch.set_measurement_periode(20)
+    assert batch.confirmed == {"BiasCurrent": [2.]*4, "InptMeasurementPeriod": 20}
+
+def test_confirm_value_adjusted_by_the_driver(websq):
+    # the simulator rounds the period to whole ms, at least 1
+    for commanded, applied in ((10.5, 10), (0, 1), (20, 20)):
+        start = time.time()
+        if commanded == applied:
+            assert websq.set_measurement_periode(commanded, confirm=True) == applied
+        else:
+            with pytest.warns(UserWarning, match="InptMeasurementPeriod"):
+                assert websq.set_measurement_periode(commanded, confirm=True) == applied
+        assert time.time() - start < 1
+
+def test_gating_discards_frames_before_the_change(websq):
+    websq.enable_detectors(True, confirm=True)
+    websq.set_bias_current([0.]*4, confirm=True)
+    websq.set_bias_current([25.]*4, confirm=True)
+    changed = HostTime(time.time())
+    cnts, host_times = websq.aquire_cnts(5, timeout=5, after=changed, host_times=True)
+    assert (host_times > changed).all()
+    assert (cnts[:, 1:] > 0).all()
+
+def test_more_frames_than_buffer_fail_fast(websq):
+    for acquire in (lambda: websq.aquire_cnts(150),
+                    lambda: websq.aquire_cnts(150, after=HostTime(time.time())),
+                    lambda: funcs.bias_sweep(websq, [25], 150)):
+        start = time.time()
+        with pytest.raises(ValueError):
+            acquire()
+        assert time.time() - start < 1
+
+def test_fast_auto_calibration(websq):
+    for i in range(20):
+        currents = websq.auto_calibrate([100.]*4, timeout=2.5).result()
+        assert len(currents) == 4
+
+class QuietSimulator(WebSQSimulator):
+    """Driver which only reports StartAutoIV when asked."""
+    def _auto_iv(self):
+        with self.lock:
+            self.labels["StartAutoIV"]["value"] = True
+        time.sleep(self.autoiv_time)
+        bias = [round(float(b), 2) for b in self.model.bias_for_dark_counts(self.labels["DarkCountsAutoIV"]["value"])]
+        self._set("BiasCurrent", bias)
+        with self.lock:
+            self.labels["StartAutoIV"]["value"] = False
+
+@pytest.mark.parametrize("autoiv_time", [0.05, 0.5])
+def test_auto_calibration_without_broadcasts(autoiv_time):
+    # finished before the first request (only False is seen) or while polling
+    with QuietSimulator(control_port=0, counts_port=0, number_of_detectors=4, autoiv_time=autoiv_time) as sim:
+        with WebSQControl(CONTROL_PORT=sim.control_port, COUNTS_PORT=sim.counts_port) as websq:
+            websq.connect()
+            websq.AUTOIV_POLL = 0.2
+            start = time.time()
+            currents = websq.auto_calibrate([100.]*4, timeout=3).result()
+            assert time.time() - start < autoiv_time + 0.5
+            assert currents == sim.labels["BiasCurrent"]["value"]
@@ -0,0 +1,37 @@
+"""
+Round trips of results through ResultWriter and read_result.
+"""
+
+import numpy as np
+import pytest
+
+from countblock import CountBlock, mean_table
+from writer import ResultWriter, read_result
+
+@pytest.fixture(params=["npz", "parquet", "feather"])
+def fmt(request):
+    if request.param != "npz":
+        pytest.importorskip("pyarrow")
+    return request.param
+
+def blocks():
+    return [CountBlock(np.arange(3), np.arange(6).reshape(3, 2)*w,
+                       metadata=dict(wavelength=w, measurement_periode_ms=100, rejected=dict(total=1)),
+                       host_times=np.arange(3.) + 0.5) for w in (1260, 1270)]
+
+def test_round_trip(tmp_path, fmt):
+    table = mean_table(blocks(), "wavelength")
+    block = blocks()[0]
+    with ResultWriter(directory=str(tmp_path), format=fmt) as writer:
+        writer.write(table, "measurements")
+        writer.write(block, "counts1260")
+        writer.write(CountBlock(block.timestamps, block.counts), "bare")
+    assert read_result(str(tmp_path / ("measurements." + fmt))).equals(table)
+    # the raw counts and all metadata, not only the count rates
+    read = read_result(str(tmp_path / ("counts1260." + fmt)))
+    assert isinstance(read, CountBlock)
+    assert read.channels == block.channels and read.metadata == block.metadata
+    for name in ("timestamps", "counts", "host_times"):
+        assert np.array_equal(getattr(read, name), getattr(block, name))
+    bare = read_result(str(tmp_path / ("bare." + fmt)))
+    assert bare.host_times is None and bare.metadata == {} and np.array_equal(bare.counts, block.counts)